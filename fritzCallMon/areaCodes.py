@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+# import root directory into python module search path
+sys.path.insert(1, os.getcwd())  # noqa
+
+logger = logging.getLogger(__name__)
+
+# default length of an area code if the number does not match any known code (e.g. 0800)
+DEFAULT_ONKZ_LENGTH = 4
+
+# layout of the compiled area code index, see compile_area_codes()
+_MAGIC = b'ONKZIDX1'
+_HEADER = struct.Struct('<8sqqIIII')
+_BUCKET = struct.Struct('<IIII')
+_RECORD = struct.Struct('<IH')
+_REF = struct.Struct('<I')
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_area_code_file(areacodefile):
+    return os.path.join(
+        os.path.dirname(__file__),
+        'data',
+        areacodefile,
+    )
+
+
+def get_area_code_index(areacodefile):
+    """
+    Returns the process wide AreaCodeIndex for the given area code file.
+    The file is only read once, all components share the same index.
+    """
+    fname = get_area_code_file(areacodefile)
+    with _indexes_lock:
+        index = _indexes.get(fname)
+        if index is None:
+            index = AreaCodeIndex(fname)
+            _indexes[fname] = index
+        return index
+
+
+class AreaCodeIndex():
+    """
+    Longest prefix lookup of the german area codes (ONKz).
+    The area code file is compiled into a binary index next to it, which is
+    memory mapped. The codes are bucketed by their length, a lookup does a
+    binary search in each bucket starting with the longest codes.
+    The index gets rebuilt whenever the area code file changes.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.buffer = b''
+        self.lengths = ()
+        self._buckets = {}
+        self._n_codes = 0
+        self._records = 0
+        self._refs = 0
+        self._place_offsets = 0
+        self._places = 0
+        self._load(fname)
+
+    def _load(self, fname):
+        if not os.path.isfile(fname):
+            logger.error('%s not found', fname)
+            return
+        stat = os.stat(fname)
+        for path in get_compiled_files(fname):
+            buffer = self._map(path, stat)
+            if buffer is not None:
+                break
+        else:
+            buffer = compile_area_codes(fname)
+            for path in get_compiled_files(fname):
+                try:
+                    _write_atomic(path, buffer)
+                    logger.info('%s has been compiled to %s', fname, path)
+                    break
+                except OSError as e:
+                    logger.debug('Cannot write %s: %s', path, e)
+            else:
+                logger.warning('Cannot save compiled area codes, using them from memory')
+        self._open(buffer)
+
+    def _map(self, path, stat):
+        try:
+            with open(path, mode='rb') as file:
+                buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(buffer) < _HEADER.size:
+            buffer.close()
+            return None
+        magic, mtime_ns, size = _HEADER.unpack_from(buffer)[:3]
+        if magic != _MAGIC or mtime_ns != stat.st_mtime_ns or size != stat.st_size:
+            buffer.close()
+            return None
+        return buffer
+
+    def _open(self, buffer):
+        magic, mtime_ns, size, n_codes, n_refs, n_places, n_buckets = _HEADER.unpack_from(buffer)
+        offset = _HEADER.size
+        buckets = {}
+        for i in range(n_buckets):
+            length, codes_offset, first, count = _BUCKET.unpack_from(buffer, offset)
+            buckets[length] = (codes_offset, first, count)
+            offset += _BUCKET.size
+        self.buffer = buffer
+        self._buckets = buckets
+        self.lengths = tuple(sorted(buckets, reverse=True))
+        self._n_codes = n_codes
+        self._records = offset + sum(length * bucket[2] for length, bucket in buckets.items())
+        self._refs = self._records + n_codes * _RECORD.size
+        self._place_offsets = self._refs + n_refs * _REF.size
+        self._places = self._place_offsets + (n_places + 1) * _REF.size
+
+    def __len__(self):
+        return self._n_codes
+
+    def _find(self, code):
+        bucket = self._buckets.get(len(code))
+        if bucket is None:
+            return None
+        codes_offset, first, count = bucket
+        length = len(code)
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = codes_offset + mid * length
+            candidate = self.buffer[start:start + length]
+            if candidate < code:
+                lo = mid + 1
+            elif candidate > code:
+                hi = mid
+            else:
+                return first + mid
+        return None
+
+    def _get_place(self, place_id):
+        start, end = struct.unpack_from('<II', self.buffer, self._place_offsets + place_id * _REF.size)
+        return self.buffer[self._places + start:self._places + end].decode('utf-8')
+
+    def _get_record_places(self, record):
+        first_ref, n_refs = _RECORD.unpack_from(self.buffer, self._records + record * _RECORD.size)
+        return tuple(
+            self._get_place(_REF.unpack_from(self.buffer, self._refs + (first_ref + i) * _REF.size)[0])
+            for i in range(n_refs))
+
+    def _match(self, phone_number):
+        if not phone_number.isdigit():
+            return None
+        number = phone_number.encode('ascii')
+        for length in self.lengths:
+            if len(number) < length:
+                continue
+            record = self._find(number[0:length])
+            if record is not None:
+                return length, record
+        return None
+
+    def lookup(self, phone_number):
+        """
+        Returns the tuple (area code, places) of the longest area code the
+        given number starts with or None if no area code matches.
+        """
+        match = self._match(phone_number)
+        if match:
+            return phone_number[0:match[0]], self._get_record_places(match[1])
+        return None
+
+    def get_area_code(self, phone_number):
+        match = self._match(phone_number)
+        if match:
+            return phone_number[0:match[0]]
+        return None
+
+    def get_length(self, phone_number):
+        match = self._match(phone_number)
+        if match:
+            return match[0]
+        return DEFAULT_ONKZ_LENGTH
+
+    def get_places(self, phone_number):
+        match = self.lookup(phone_number)
+        if match:
+            return match[1]
+        return ()
+
+
+def get_compiled_files(fname):
+    """
+    Candidate locations of the compiled area code index, the data directory
+    first and the temp directory if the package is installed read only.
+    """
+    name = os.path.basename(fname) + '.idx'
+    return (
+        fname + '.idx',
+        os.path.join(tempfile.gettempdir(), 'fritzCallMon', name),
+    )
+
+
+def compile_area_codes(fname):
+    """
+    Compiles the tab separated area code file into the binary index format:
+    header, length buckets of sorted fixed width codes, one record per code
+    pointing into the place references and an interned table of place names.
+    """
+    codes = {}
+    with open(fname, encoding='utf-8', mode='r') as csvfile:
+        for row in csvfile:
+            fields = row.strip().split('\t')
+            if not fields[0].isdigit():
+                continue
+            places = codes.setdefault(fields[0], [])
+            places += [place for place in fields[1:] if place and place not in places]
+
+    place_ids = {}
+    for places in codes.values():
+        for place in places:
+            place_ids.setdefault(place, len(place_ids))
+
+    lengths = sorted({len(code) for code in codes}, reverse=True)
+    ordered = []
+    bucket_table = []
+    codes_blob = bytearray()
+    codes_offset = _HEADER.size + len(lengths) * _BUCKET.size
+    for length in lengths:
+        bucket = sorted(code for code in codes if len(code) == length)
+        bucket_table.append(_BUCKET.pack(length, codes_offset + len(codes_blob), len(ordered), len(bucket)))
+        codes_blob += ''.join(bucket).encode('ascii')
+        ordered += bucket
+
+    records = bytearray()
+    refs = bytearray()
+    n_refs = 0
+    for code in ordered:
+        records += _RECORD.pack(n_refs, len(codes[code]))
+        for place in codes[code]:
+            refs += _REF.pack(place_ids[place])
+        n_refs += len(codes[code])
+
+    place_offsets = bytearray(_REF.pack(0))
+    places_blob = bytearray()
+    for place in place_ids:
+        places_blob += place.encode('utf-8')
+        place_offsets += _REF.pack(len(places_blob))
+
+    stat = os.stat(fname)
+    header = _HEADER.pack(
+        _MAGIC, stat.st_mtime_ns, stat.st_size,
+        len(ordered), n_refs, len(place_ids), len(lengths))
+    return b''.join((
+        header, b''.join(bucket_table), codes_blob, records, refs, place_offsets, places_blob))
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, mode='wb') as file:
+            file.write(data)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _linear_scan_length(onkz, phone_number):
+    for row in onkz:
+        if phone_number[0:len(row[0])] == row[0]:
+            return len(row[0])
+    return DEFAULT_ONKZ_LENGTH
+
+
+if __name__ == '__main__':
+    import argparse
+    import random
+    import timeit
+
+    parser = argparse.ArgumentParser(
+        description='Compile the area code file and benchmark the area code index')
+    parser.add_argument('-a', '--areacodefile',
+                        default='vorwahlen_deutschland.txt',
+                        help='File name in the data directory where the area codes are listed.')
+    parser.add_argument('-c', '--compile', action='store_true',
+                        help='Only compile the area code file.')
+    cli = parser.parse_args()
+
+    fname = get_area_code_file(cli.areacodefile)
+    if cli.compile:
+        path = get_compiled_files(fname)[0]
+        _write_atomic(path, compile_area_codes(fname))
+        print(f'{fname} has been compiled to {path}')
+        sys.exit(0)
+
+    # micro benchmark of the index against the former linear scan of the area code file
+    start = time.perf_counter()
+    index = AreaCodeIndex(fname)
+    print(f'index opened in {(time.perf_counter() - start) * 1000:.3f} ms')
+    with open(fname, encoding='utf-8', mode='r') as csvfile:
+        onkz = [row.strip().split('\t') for row in csvfile]
+    random.seed(0)
+    numbers = [random.choice(onkz)[0] + str(random.randint(10000, 9999999)) for i in range(1000)]
+    numbers += ['0800' + str(random.randint(100000, 999999)) for i in range(100)]
+    scan = timeit.timeit(lambda: [_linear_scan_length(onkz, n) for n in numbers], number=3) / 3
+    indexed = timeit.timeit(lambda: [index.get_length(n) for n in numbers], number=3) / 3
+    print(f'{len(index)} area codes, {len(numbers)} numbers')
+    print(f'linear scan: {scan * 1000:10.3f} ms')
+    print(f'index:       {indexed * 1000:10.3f} ms ({scan / indexed:.0f}x)')
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import sys
+import wave
+from array import array
+
+logger = logging.getLogger(__name__)
+
+"""
+Optional preprocessing of the phone messages before the speech recognition
+
+ - reads PCM WAV files with 8 or 16 bit samples, stereo is downmixed to mono
+ - trims leading and trailing silence, keeping some padding around the speech
+ - resamples to a lower sample rate if the file has a higher one
+ - splits long messages at the quietest frame near the chunk limit, so the chunks
+   can be transcribed in parallel
+ - writes the chunks as 16 bit mono WAV files next to the phone message
+
+   python audioPreprocessor.py message.wav
+"""
+
+FRAME_MS = 20
+
+
+def read_wav(filename):
+    """
+    Returns the samples as 16 bit mono array and the sample rate
+    """
+    with wave.open(filename, 'rb') as wav:
+        channels, width, rate = wav.getnchannels(), wav.getsampwidth(), wav.getframerate()
+        data = wav.readframes(wav.getnframes())
+    if width == 1:
+        samples = array('h', ((byte - 128) << 8 for byte in data))
+    elif width == 2:
+        samples = array('h', data)
+        if sys.byteorder == 'big':
+            samples.byteswap()
+    else:
+        raise ValueError(f'{width * 8} bit samples are not supported')
+    if channels > 1:
+        samples = array('h', (
+            sum(samples[i:i + channels]) // channels for i in range(0, len(samples), channels)))
+    return samples, rate
+
+
+def write_wav(filename, samples, rate):
+    if sys.byteorder == 'big':
+        samples = array('h', samples)
+        samples.byteswap()
+    with wave.open(filename, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(samples.tobytes())
+
+
+def frame_levels(samples, rate):
+    # peak level of every frame
+    size = max(1, rate * FRAME_MS // 1000)
+    return size, [max(map(abs, samples[i:i + size])) for i in range(0, len(samples), size)]
+
+
+def trim_silence(samples, rate, threshold=500, padding_ms=300):
+    size, levels = frame_levels(samples, rate)
+    loud = [n for n, level in enumerate(levels) if level > threshold]
+    if not loud:
+        return samples[:0]
+    padding = padding_ms // FRAME_MS
+    start = max(0, loud[0] - padding) * size
+    end = min(len(levels), loud[-1] + 1 + padding) * size
+    return samples[start:end]
+
+
+def resample(samples, rate, target):
+    """
+    Linear interpolation to the lower target rate, higher rates are not created
+    """
+    if not target or target >= rate or not samples:
+        return samples, rate
+    step = rate / target
+    last = len(samples) - 1
+    resampled = array('h')
+    pos = 0.0
+    while pos <= last:
+        i = int(pos)
+        frac = pos - i
+        nxt = samples[i + 1] if i < last else samples[i]
+        resampled.append(int(samples[i] + (nxt - samples[i]) * frac))
+        pos += step
+    return resampled, target
+
+
+def split_chunks(samples, rate, max_seconds=30):
+    """
+    Splits into chunks of at most max_seconds at the quietest frame of the last fifth of each chunk
+    """
+    limit = int(max_seconds * rate)
+    if not max_seconds or len(samples) <= limit:
+        return [samples]
+    size, levels = frame_levels(samples, rate)
+    chunks = []
+    start = 0
+    while len(samples) - start > limit:
+        first = (start + limit * 4 // 5) // size
+        last = (start + limit) // size
+        cut = min(range(first, last), key=lambda n: levels[n]) * size
+        if cut <= start:
+            cut = start + limit
+        chunks.append(samples[start:cut])
+        start = cut
+    chunks.append(samples[start:])
+    return chunks
+
+
+class AudioPreprocessor():
+
+    def __init__(self, threshold=500, sample_rate=8000, chunk_seconds=30):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.chunk_seconds = chunk_seconds
+
+    def process(self, filename):
+        """
+        Returns the names of the chunk files and the statistics of the preprocessing
+        """
+        samples, rate = read_wav(filename)
+        seconds = len(samples) / rate
+        samples = trim_silence(samples, rate, self.threshold)
+        samples, rate = resample(samples, rate, self.sample_rate)
+        base = os.path.splitext(filename)[0]
+        chunks = []
+        for n, chunk in enumerate(split_chunks(samples, rate, self.chunk_seconds) if samples else []):
+            chunks.append(f'{base}.chunk{n}.wav')
+            write_wav(chunks[-1], chunk, rate)
+        stats = {
+            'bytes_in': os.path.getsize(filename),
+            'bytes_out': sum(os.path.getsize(chunk) for chunk in chunks),
+            'seconds_in': round(seconds, 1),
+            'seconds_out': round(len(samples) / rate, 1),
+            'chunks': len(chunks),
+        }
+        logger.debug('%s preprocessed %s', filename, stats)
+        return chunks, stats
+
+
+if __name__ == '__main__':
+    import math
+    import tempfile
+    import time
+
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    else:
+        # 2s silence, 70s of speech like tones with short pauses, 3s silence at 16 kHz
+        rate = 16000
+        samples = array('h', [0] * 2 * rate)
+        for n in range(70 * rate):
+            level = 0 if (n // (rate // 2)) % 7 == 6 else 8000
+            samples.append(int(level * math.sin(n * 2 * math.pi * 440 / rate)))
+        samples.extend([0] * 3 * rate)
+        filename = os.path.join(tempfile.mkdtemp(), 'rec.0.000.wav')
+        write_wav(filename, samples, rate)
+    start = time.monotonic()
+    chunks, stats = AudioPreprocessor().process(filename)
+    print(f'{time.monotonic() - start:.2f}s', stats)
+    print(chunks)
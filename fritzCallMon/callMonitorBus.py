@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+"""
+In-process publish/subscribe bus for the call monitor events
+
+ - Every subscriber gets its own bounded queue, the same event object is put on all of them.
+ - If the queue of a subscriber is full, the policy of the subscriber decides:
+    - drop_oldest: the oldest waiting event is dropped for the new one
+    - drop_newest: the new event is dropped
+    - block: the publisher waits until the subscriber has taken an event (backpressure),
+      this stalls all other subscribers as well and is meant for consumers which must not lose events
+ - Per subscriber the received and dropped events, the maximum queue depth and the latency
+   from receiving the line until the subscriber takes the event are counted.
+"""
+
+
+class Subscription():
+
+    def __init__(self, name, maxsize=1000, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown queue policy {policy}, use one of {", ".join(POLICIES)}')
+        self.name = name
+        self.policy = policy
+        self.queue = asyncio.Queue(maxsize)
+        self.statistics = {'received': 0, 'dropped': 0, 'max_depth': 0,
+                           'events': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+
+    async def put(self, event):
+        if self.queue.full():
+            if self.policy == DROP_NEWEST:
+                self._dropped(event)
+                return
+            if self.policy == DROP_OLDEST:
+                self._dropped(self.queue.get_nowait())
+        await self.queue.put(event)
+        self.statistics['received'] += 1
+        self.statistics['max_depth'] = max(self.statistics['max_depth'], self.queue.qsize())
+
+    def _dropped(self, event):
+        self.statistics['dropped'] += 1
+        if self.statistics['dropped'] % 100 == 1:
+            logger.warning('Queue of %s is full, %s events dropped so far, last %s',
+                           self.name, self.statistics['dropped'], event)
+
+    async def get(self):
+        event = await self.queue.get()
+        received = getattr(event, 'received', None)
+        if received is not None:
+            # time from receiving the message until the consumer starts processing it
+            latency = time.monotonic() - received
+            self.statistics['events'] += 1
+            self.statistics['latency_total'] += latency
+            self.statistics['latency_max'] = max(self.statistics['latency_max'], latency)
+            logger.debug('%s latency %.1f ms, %s waiting', self.name, latency * 1000, self.queue.qsize())
+        return event
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+
+class CallMonitorBus():
+
+    def __init__(self, maxsize=1000, policy=DROP_OLDEST):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.subscriptions = {}
+
+    def subscribe(self, name, maxsize=None, policy=None):
+        """
+        Registers a subscriber, returns its Subscription to take the events from
+        """
+        if name in self.subscriptions:
+            raise ValueError(f'{name} is already subscribed')
+        subscription = Subscription(
+            name,
+            self.maxsize if maxsize is None else maxsize,
+            self.policy if policy is None else policy)
+        self.subscriptions[name] = subscription
+        return subscription
+
+    def unsubscribe(self, name):
+        self.subscriptions.pop(name, None)
+
+    async def publish(self, event):
+        for subscription in list(self.subscriptions.values()):
+            await subscription.put(event)
+
+    def get_statistics(self):
+        return {name: dict(subscription.statistics, waiting=subscription.queue.qsize())
+                for name, subscription in self.subscriptions.items()}
+
+
+if __name__ == '__main__':
+    async def main():
+        bus = CallMonitorBus(maxsize=10)
+        fast = bus.subscribe('fast')
+        slow = bus.subscribe('slow', policy=DROP_OLDEST)
+
+        async def consume(subscription, delay):
+            async for event in subscription:
+                if event is None:
+                    return
+                await asyncio.sleep(delay)
+
+        consumers = asyncio.gather(consume(fast, 0), consume(slow, 0.01))
+        for n in range(1000):
+            await bus.publish(n)
+            await asyncio.sleep(0)
+        await bus.publish(None)
+        await consumers
+        print(bus.get_statistics())
+
+    asyncio.run(main())
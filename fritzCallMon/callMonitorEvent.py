@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+RING = 'RING'
+CALL = 'CALL'
+CONNECT = 'CONNECT'
+DISCONNECT = 'DISCONNECT'
+
+"""
+Lines sent by the Fritzbox call monitor:
+    date;RING;ConnectionID;CallerNumber;CalledNumber;Line;
+    date;CALL;ConnectionID;Port;CallerNumber;CalledNumber;Line;
+    date;CONNECT;ConnectionID;Port;Number;
+    date;DISCONNECT;ConnectionID;Duration;
+"""
+
+
+class CallMonitorEvent():
+    """
+    Immutable event of the call monitor. number is the number of the other
+    party for RING, CALL and CONNECT events. received is the monotonic time
+    the line has been received.
+    One event is passed to all consumers, it must not be changed.
+    """
+    __slots__ = ('type', 'timestamp', 'connection_id', 'port', 'caller', 'called',
+                 'number', 'line', 'duration', 'received')
+
+    def __init__(self, type, timestamp, connection_id, port=None, caller=None, called=None,
+                 number=None, line=None, duration=None, received=None):
+        set_attr = super().__setattr__
+        set_attr('type', type)
+        set_attr('timestamp', timestamp)
+        set_attr('connection_id', connection_id)
+        set_attr('port', port)
+        set_attr('caller', caller)
+        set_attr('called', called)
+        set_attr('number', number)
+        set_attr('line', line)
+        set_attr('duration', duration)
+        set_attr('received', time.monotonic() if received is None else received)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{__class__.__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{__class__.__name__} is immutable')
+
+    def __repr__(self):
+        return '{}({})'.format(__class__.__name__, ', '.join(
+            f'{name}={getattr(self, name)!r}' for name in self.__slots__
+            if name != 'received' and getattr(self, name) is not None))
+
+
+def parse_event(line):
+    """
+    Parses a line of the call monitor, returns None for malformed lines
+    """
+    try:
+        fields = (line.decode('utf-8', 'replace') if isinstance(line, bytes) else line).split(';')
+        event_type = fields[1]
+        timestamp = datetime.datetime.strptime(fields[0], '%d.%m.%y %H:%M:%S')
+        connection_id = int(fields[2])
+        if event_type == RING:
+            return CallMonitorEvent(
+                RING, timestamp, connection_id,
+                caller=fields[3], called=fields[4], number=fields[3], line=fields[5])
+        if event_type == CALL:
+            return CallMonitorEvent(
+                CALL, timestamp, connection_id, port=fields[3],
+                caller=fields[4], called=fields[5], number=fields[5], line=fields[6])
+        if event_type == CONNECT:
+            return CallMonitorEvent(
+                CONNECT, timestamp, connection_id, port=fields[3], number=fields[4])
+        if event_type == DISCONNECT:
+            return CallMonitorEvent(
+                DISCONNECT, timestamp, connection_id, duration=int(fields[3]))
+        logger.warning('Unknown call monitor event %s', line)
+    except (IndexError, ValueError):
+        logger.warning('Malformed call monitor line %s', line)
+    return None
+
+
+if __name__ == '__main__':
+    for line in (
+            b'17.10.26 13:00:00;RING;0;0621123456;555;SIP0;',
+            b'17.10.26 13:00:03;CONNECT;0;40;0621123456;',
+            b'17.10.26 13:00:15;DISCONNECT;0;12;',
+            b'17.10.26 13:01:00;CALL;1;10;555;0301234567;SIP0;',
+            b'17.10.26 13:01:00;CALL;1;'):
+        print(parse_event(line))
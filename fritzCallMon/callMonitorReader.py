@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# the call monitor lines are short, longer lines are garbage and get skipped
+LINE_LIMIT = 4096
+
+
+async def read_lines(reader):
+    """
+    Yields the lines received from the call monitor without line endings.
+    Lines split across several chunks are joined, several lines received
+    in one chunk are yielded one by one. Stops when the connection is closed.
+    """
+    skip = False
+    while True:
+        try:
+            line = await reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError as e:
+            # connection closed, a last line may lack its line ending
+            if e.partial.strip() and not skip:
+                yield e.partial.strip()
+            return
+        except asyncio.LimitOverrunError as e:
+            if not skip:
+                logger.error('Skipping call monitor line longer than %s bytes', LINE_LIMIT)
+            await reader.readexactly(e.consumed)
+            skip = True
+            continue
+        except OSError as e:
+            logger.error('Call monitor connection error %s', e)
+            return
+        if skip:
+            # rest of the skipped line
+            skip = False
+            continue
+        line = line.strip()
+        if line:
+            yield line
+
+
+async def open_call_monitor(host, port):
+    return await asyncio.open_connection(host, port, limit=LINE_LIMIT)
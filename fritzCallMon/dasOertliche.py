@@ -4,72 +4,178 @@ import logging
 import os
 import re
 import sys
-from ast import literal_eval
-
-import certifi
-import urllib3
 
 # import root directory into python module search path
 sys.path.insert(1, os.getcwd())  # noqa
 
+from httpPool import get_http_pool
 from logs import get_logger
 
 logger = logging.getLogger(__name__)
 
+NOT_FOUND = b'keine Treffer finden'
+# first result of the page, e.g. var item = {pc:'68159',na:'Name',ci:'Mannheim',...};
+ITEM = re.compile(rb'var\s+item\s*=\s*\{(.*?)\};', re.DOTALL)
+FIELD = re.compile(r"""(\w+)\s*:\s*(?:'((?:[^'\\]|\\.)*)'|"((?:[^"\\]|\\.)*)"|([^,]*))""", re.DOTALL)
+ESCAPE = re.compile(r'\\(u[0-9a-fA-F]{4}|x[0-9a-fA-F]{2}|.)', re.DOTALL)
+ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f'}
+FIELDS = ('pc', 'na', 'ci', 'st', 'hn', 'ph')
+
+
+def _unescape(match):
+    escape = match.group(1)
+    if escape[0] in 'ux' and len(escape) > 1:
+        return chr(int(escape[1:], 16))
+    return ESCAPES.get(escape, escape)
+
+
+def extract_entry(content):
+    """
+    Returns name (na), street (st), house number (hn), postcode (pc), city (ci) and
+    phone (ph or mph for mobile numbers) of the first result of a DasOertliche page,
+    None if the page has no result. Raises ValueError for unknown pages.
+    """
+    if NOT_FOUND in content:
+        return None
+    item = ITEM.search(content)
+    if item is None:
+        raise ValueError('No result found in the DasOertliche page')
+    entry = dict.fromkeys(FIELDS + ('mph', ), '')
+    for key, single, double, bare in FIELD.findall(item.group(1).decode('utf-8', 'ignore')):
+        if key in entry:
+            value = single or double or bare.strip()
+            if '\\' in value:
+                value = ESCAPE.sub(_unescape, value)
+            entry[key] = value.replace('&nbsp;', ' ').strip()
+    phone = entry['ph'].replace('(', '').replace(')', '-').replace(' ', '-', 1).replace(' ', '')
+    entry['ph'] = ''
+    entry['mph' if phone[:3] in ('015', '016', '017') else 'ph'] = phone
+    return entry
+
 
 class DasOertliche():
     """
     Reverse Lookup of a given number using DasOertliche.de
+    The given LookupCache is consulted before querying DasOertliche.de,
+    queries are throttled by the given RateLimiter
     """
 
-    def __init__(self, lookup_number):
+    def __init__(self, lookup_number, cache=None, rate_limiter=None):
         self.logger = get_logger()
+        self.failed = False
+        self.entry = None
+        if cache:
+            cached, self.name = cache.get(lookup_number)
+            if cached:
+                return
+        if rate_limiter:
+            rate_limiter.acquire()
         self.name = self._lookup_dasoertliche(lookup_number)
-
-    def _init_dict(self):
-        transTable = ['pc', 'na', 'ci', 'st', 'hn', 'ph', 'mph', 'recuid']
-        data_dict = {}
-        for key in transTable:
-            data_dict[key] = ''
-        return data_dict
+        if cache and not self.failed:
+            cache.set(lookup_number, self.name)
 
     def _lookup_dasoertliche(self, number):
-        http = urllib3.PoolManager(
-            cert_reqs='CERT_REQUIRED', ca_certs=certifi.where())
         url = f'https://www.dasoertliche.de/Controller?form_name=search_inv&ph={number}'
         headers = {
             'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/54.0.2840.90 Safari/537.36'}
-        response = http.request('GET', url, headers=headers)
-        content = response.data.decode("utf-8", "ignore") \
-            .replace('\t', '').replace('\n', '').replace('\r', '').replace('&nbsp;', ' ')
-        if content.find('keine Treffer finden') > -1:
-            return
+        response = get_http_pool().request('GET', url, headers=headers)
         try:
-            handlerData = literal_eval(
-                (re.search(r'handlerData\s*=\s*(.*?);', content).group(1)).replace("null", "None"))
-            # item list matching to address list
-            itemList = re.search(
-                'var item = {(.*?)};', content).group(1).split(',')
-            for m in range(len(handlerData)):
-                data_dict = self._init_dict()
-                for singleItem in itemList:
-                    item = singleItem.split(':', 1)
-                    i_id = item[0].strip()
-                    if i_id in data_dict.keys():
-                        if i_id == 'ph':
-                            phone = eval(item[1]).replace('(', '').replace(
-                                ')', '-').replace(' ', '-', 1).replace(' ', '')
-                            if phone[:3] in ('015', '016', '017'):
-                                data_dict['mph'] = phone
-                            else:
-                                data_dict['ph'] = phone
-                        else:
-                            data_dict[i_id] = eval(item[1])
-            return data_dict['na']
-        except Exception:
+            self.entry = extract_entry(response.data)
+        except ValueError:
+            self.failed = True
             logger.error("Telefonbuchsuche DasOertliche error", exc_info=True)
+            return
+        return self.entry['na'] if self.entry else None
 
 
 if __name__ == '__main__':
-    DO = DasOertliche(lookup_number='012345678')
-    print(DO.name)
+    import argparse
+    import glob
+    import time
+    from ast import literal_eval
+
+    parser = argparse.ArgumentParser(description='Reverse lookup using DasOertliche.de')
+    parser.add_argument('number', nargs='?', help='Number to look up.')
+    parser.add_argument('--pages', default=os.path.join(
+                            os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'data', 'dasoertliche'),
+                        help='Directory of saved result pages (*.html) to check and benchmark the extractor with. '
+                        'The expected name is given in a <page>.name file next to the page, an empty file means '
+                        'no result. Default: tests/data/dasoertliche of the source tree')
+    parser.add_argument('--count', type=int, default=0,
+                        help='Number of synthetic result pages to use instead of the saved pages.')
+    parser.add_argument('--repeat', type=int, default=100,
+                        help='Number of times the pages are extracted for the benchmark. Default: 100')
+    cli = parser.parse_args()
+
+    if cli.number:
+        DO = DasOertliche(lookup_number=cli.number)
+        print(DO.name, DO.entry)
+        sys.exit()
+
+    def legacy_extract(data):
+        # the former extraction using eval, as reference for the benchmark
+        content = data.decode("utf-8", "ignore") \
+            .replace('\t', '').replace('\n', '').replace('\r', '').replace('&nbsp;', ' ')
+        if content.find('keine Treffer finden') > -1:
+            return None
+        handlerData = literal_eval(
+            (re.search(r'handlerData\s*=\s*(.*?);', content).group(1)).replace("null", "None"))
+        itemList = re.search('var item = {(.*?)};', content).group(1).split(',')
+        for m in range(len(handlerData)):
+            data_dict = dict.fromkeys(['pc', 'na', 'ci', 'st', 'hn', 'ph', 'mph', 'recuid'], '')
+            for singleItem in itemList:
+                item = singleItem.split(':', 1)
+                if item[0].strip() in data_dict:
+                    data_dict[item[0].strip()] = eval(item[1])
+        return data_dict['na']
+
+    def synthetic_page(n):
+        filler = '<div class="ad">{}</div>\n'.format('x' * 200) * 400
+        if n % 10 == 0:
+            return f'<html>{filler}Wir konnten leider keine Treffer finden.</html>'.encode(), None
+        name = f'M\u00fcller & S\u00f6hne {n}'
+        item = (f"var item = {{pc:'68159',na:'{name}',ci:'Mannheim',st:'Hauptstr.',hn:'{n}',"
+                f"ph:'(0621) 12 34 {n:02d}',recuid:'{n}'}};")
+        handler = f'handlerData = [["{n}", null, "x"], ["{n + 1}", null, "y"]];'
+        return f'<html><head><meta charset="utf-8"></head>{filler}<script>{handler}\n{item}</script>{filler}</html>'.encode(), name
+
+    if not cli.count:
+        pages = []
+        for file in sorted(glob.glob(os.path.join(cli.pages, '*.html'))):
+            with open(file, 'rb') as page:
+                data = page.read()
+            if os.path.exists(os.path.splitext(file)[0] + '.name'):
+                with open(os.path.splitext(file)[0] + '.name', encoding='utf-8') as name:
+                    expected = name.read().strip() or None
+            else:
+                expected = False
+            pages.append((os.path.basename(file), data, expected))
+    else:
+        pages = [(f'synthetic{n}', *synthetic_page(n)) for n in range(cli.count)]
+
+    if not pages:
+        print(f'No pages found in {cli.pages}')
+        sys.exit(1)
+    errors = 0
+    # expected is the name, None for a page without result or False if it is not known
+    for title, data, expected in pages:
+        try:
+            entry = extract_entry(data)
+        except Exception as e:
+            entry = e
+        name = entry['na'] if isinstance(entry, dict) else entry
+        if expected is not False and name != expected:
+            errors += 1
+            print(f'{title}: expected {expected!r}, got {name!r}')
+    print(f'{len(pages) - errors} of {len(pages)} pages extracted as expected')
+    for extract in (extract_entry, legacy_extract):
+        start = time.perf_counter()
+        for _ in range(cli.repeat):
+            for title, data, expected in pages:
+                try:
+                    extract(data)
+                except Exception:
+                    pass
+        elapsed = time.perf_counter() - start
+        print(f'{extract.__name__}: {len(pages)} pages, {elapsed / len(pages) / cli.repeat * 1e6:.1f} us per page')
+    sys.exit(1 if errors else 0)
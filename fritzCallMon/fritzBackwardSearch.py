@@ -5,6 +5,8 @@ import logging
 import os
 import re
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # import root directory into python module search path
 sys.path.insert(1, os.getcwd())  # noqa
@@ -12,94 +14,170 @@ sys.path.insert(1, os.getcwd())  # noqa
 from fritzconnection import FritzConnection
 from fritzconnection.lib.fritzcall import Call
 
-from dasOertliche import DasOertliche
-from fritzCalls import FritzCalls, get_names_not_found, set_names_not_found
+from areaCodes import get_area_code_index
+from fritzCalls import FritzCalls, get_names_not_found
 from fritzPhonebook import MyFritzPhonebook
+from httpPool import get_http_pool
 from logs import get_logger
+from lookupCache import get_lookup_cache, get_stem_cache
+from lookupProviders import get_lookup_chain
+from namesNotFound import DAY
 from prefs import read_configuration
+from singleFlight import get_single_flight_statistics
 
 logger = logging.getLogger(__name__)
 
 
-args = argparse.Namespace()
-args.logfile = ''
-
-
 class FritzBackwardSearch():
 
-    def __init__(self, connection=None):
+    def __init__(self, connection=None, prefs=None):
         self.logger = get_logger()
-        self.prefs = read_configuration()
-        self.namesNotFound = []
+        self.prefs = prefs or read_configuration()
+        # the resolver state is loaded once and kept for all searches
+        self.namesNotFound = get_names_not_found(
+            self.prefs['name_not_found_file'],
+            ttl=float(self.prefs.get('name_not_found_ttl', 0)) * DAY)
+        self.fritzCalls = None
         self.calldict = []
-        global args
-        args = self._get_cli_arguments()
+        self.args = self._get_cli_arguments()
         if connection:
             self.connection = connection
         else:
             self.connection = FritzConnection(
-                address=args.address,
-                port=args.port,
-                user=args.username,
-                password=args.password)
+                address=self.args.address,
+                port=self.args.port,
+                user=self.args.username,
+                password=self.args.password)
         self.phonebook = MyFritzPhonebook(
             connection=self.connection,
             name=self.prefs['fritz_phone_book'],
+            prefs=self.prefs,
         )
         self.areaCode = self._get_area_code()
-        self.onkz = self._read_ONKz(self.prefs['area_code_file'])
+        self.onkz = get_area_code_index(self.prefs['area_code_file'])
+        self.lookupCache = get_lookup_cache(self.prefs)
+        self.lookupChain = get_lookup_chain(self.prefs, self.connection)
+        self.stemCache = get_stem_cache(self.prefs)
+        self.resolverStatistics = {
+            'resolutions': 0, 'deduplicated': 0, 'stem_hits': 0, 'queries': 0, 'max_queries': 0}
+        self.resolverLock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=int(self.prefs.get('lookup_workers', 4)),
+            thread_name_prefix='lookup')
         self.logger.info('%s has been started', __class__.__name__)
 
     def _get_names(self):
+        """
+        Returns the names found and whether a lookup failed, so the calls have to be searched again
+        """
         foundlist = {}
+        notFoundList = []
+        # a caller listed several times is resolved once
+        calls = {}
+        listed = 0
         for call in self.calldict:
-            number = self._only_numerics(call.Name)
-            origNumber = number
-            # remove international numbers
-            if number.startswith("00"):
-                fullNumber = ""
-                logger.info("Ignoring international number %s", number)
-                self.namesNotFound.append(number)
-            # remove pre-dial number for mobile
-            elif number.startswith("010"):
-                m = re.search(r"^010\d*?(01(5|6|7)\d+)", number)
-                if m:
-                    number = m.group(1)
-                fullNumber = number
-            else:
-                # add the area code for local numbers
-                m = re.search(r'^[1-9][0-9]+', number)
-                if m:
-                    fullNumber = '{}{}'.format(self.areaCode, number)
-                else:
-                    fullNumber = number
-            name = None
-            numberLogged = False
-            numberSaved = False
-            l_onkz = self._get_ONKz_length(fullNumber)
-            while (name is None and len(fullNumber) >= (l_onkz + 3)):
-                name = DasOertliche(lookup_number=fullNumber).name
-                if not name:
-                    logger.info('%s not found', fullNumber)
-                    self.namesNotFound.append(fullNumber)
-                    if fullNumber != number and not numberLogged:
-                        self.namesNotFound.append(number)
-                    if origNumber != number and not numberLogged:
-                        self.namesNotFound.append(origNumber)
-                    numberLogged = True
-                    # don't do fuzzy search for mobile numbers and 0800
-                    if fullNumber[0:3] in ("015", "016", "017") or fullNumber[0:4] in ("0800"):
-                        fullNumber = ""
-                    elif fullNumber[-1] == "0":
-                        fullNumber = fullNumber[:-2]+"0"
-                    else:
-                        fullNumber = fullNumber[:-2]+"0"
-                else:
-                    foundlist[fullNumber] = name
-                    if fullNumber != number and not numberSaved:
-                        foundlist[number] = name
-                    numberSaved = True
-        return foundlist
+            number, fullNumber = self._normalize_number(self._only_numerics(call.Name))
+            # local numbers are listed with the area code, the list is shared by all boxes
+            if fullNumber in self.namesNotFound:
+                listed += 1
+                continue
+            # a local number and the number with area code are the same caller, the call of the
+            # local number is kept, so both numbers are added to the phonebook
+            if (fullNumber or number) not in calls or number != fullNumber:
+                calls[fullNumber or number] = call
+        with self.resolverLock:
+            self.resolverStatistics['deduplicated'] += len(self.calldict) - listed - len(calls)
+        # resolve the callers concurrently, the results are merged in the order of the calls
+        lookupFailed = False
+        for found, notFound, failed in self.executor.map(self._resolve_call, calls.values()):
+            foundlist.update(found)
+            notFoundList += notFound
+            lookupFailed |= failed
+        self.namesNotFound.update(notFoundList)
+        return foundlist, lookupFailed
+
+    def _resolve_call(self, call):
+        found = {}
+        notFound = []
+        origNumber = self._only_numerics(call.Name)
+        number, fullNumber = self._normalize_number(origNumber)
+        # remove international numbers
+        if not fullNumber:
+            logger.info("Ignoring international number %s", number)
+            notFound.append(number)
+        numberLogged = False
+        queries = 0
+        stemHit = False
+        lookupFailed = False
+        name = None
+        candidates = self._get_candidates(fullNumber)
+        for n, candidate in enumerate(candidates):
+            if n == 1:
+                # the number itself is unknown, an earlier hit of one of its stems,
+                # e.g. the switchboard, resolves it without further lookups
+                stem, name = self.stemCache.find(candidates[1:])
+                if name:
+                    fullNumber, stemHit = stem, True
+                    logger.info('%s found as %s by stem %s', number, name, stem)
+                    break
+            fullNumber = candidate
+            name, failed = self.lookupChain.lookup(candidate)
+            queries += 1
+            if name:
+                # only the stems resolve other numbers, never the number itself
+                if n:
+                    self.stemCache.set(candidate, name)
+                break
+            logger.info('%s not found', candidate)
+            # a failed provider may know the number next time
+            lookupFailed |= failed
+            if not failed:
+                # local numbers are only listed with the area code of this box
+                notFound.append(candidate)
+                if origNumber != number and not numberLogged:
+                    notFound.append(origNumber)
+                numberLogged = True
+        if name:
+            found[fullNumber] = name
+            if fullNumber != number:
+                found[number] = name
+        with self.resolverLock:
+            self.resolverStatistics['resolutions'] += 1
+            self.resolverStatistics['stem_hits'] += int(stemHit)
+            self.resolverStatistics['queries'] += queries
+            self.resolverStatistics['max_queries'] = max(self.resolverStatistics['max_queries'], queries)
+        logger.debug('%s resolved with %s lookups', origNumber, queries)
+        return found, notFound, lookupFailed and not name
+
+    def _normalize_number(self, number):
+        """
+        Returns the number without the pre-dial number of mobile numbers and the number
+        including the area code of this box, the latter is empty for international numbers
+        """
+        if number.startswith("00"):
+            return number, ""
+        # remove pre-dial number for mobile
+        if number.startswith("010"):
+            m = re.search(r"^010\d*?(01(5|6|7)\d+)", number)
+            if m:
+                number = m.group(1)
+            return number, number
+        # add the area code for local numbers
+        if re.search(r'^[1-9][0-9]+', number):
+            return number, '{}{}'.format(self.areaCode, number)
+        return number, number
+
+    def _get_candidates(self, fullNumber):
+        # the number followed by the stems of the fuzzy search for the switchboard
+        candidates = []
+        l_onkz = self._get_ONKz_length(fullNumber)
+        while len(fullNumber) >= (l_onkz + 3):
+            candidates.append(fullNumber)
+            # don't do fuzzy search for mobile numbers and 0800
+            if fullNumber[0:3] in ("015", "016", "017") or fullNumber[0:4] in ("0800"):
+                break
+            fullNumber = fullNumber[:-2]+"0"
+        return candidates
 
     def _only_numerics(self, seq):
         if seq:
@@ -107,27 +185,8 @@ class FritzBackwardSearch():
             return seq_type().join(filter(seq_type.isdigit, seq))
         return ''
 
-    def _read_ONKz(self, areacodefile):  # read area code numbers
-        onkz = []
-        fname = os.path.join(
-            os.path.dirname(__file__),
-            'data',
-            areacodefile,
-        )
-        if os.path.isfile(fname):
-            with open(fname, encoding='utf-8', mode='r') as csvfile:
-                for row in csvfile:
-                    onkz.append(row.strip().split('\t'))
-        else:
-            logger.error('%s not found', fname)
-        return onkz
-
     def _get_ONKz_length(self, phone_number):
-        for row in self.onkz:
-            if phone_number[0:len(row[0])] == row[0]:
-                return len(row[0])
-        # return 4 as default length if not found (e.g. 0800)
-        return 4
+        return self.onkz.get_length(phone_number)
 
     def _get_area_code(self):
         return (
@@ -135,18 +194,40 @@ class FritzBackwardSearch():
                 'X_VoIP', 'GetVoIPCommonAreaCode')
         )['NewVoIPAreaCode']
 
+    def _get_io_counters(self):
+        counters = {}
+        for component, statistics in (
+                ('names_not_found', self.namesNotFound.statistics),
+                ('calls', self.fritzCalls.statistics if self.fritzCalls else {}),
+                ('phonebook', self.phonebook.statistics),
+                ('lookup_cache', self.lookupCache.get_statistics()),
+                ('stem_cache', self.stemCache.get_statistics()),
+                ('resolver', self.resolverStatistics)):
+            for name, value in statistics.items():
+                counters[f'{component}.{name}'] = value
+        for provider, statistics in get_single_flight_statistics().items():
+            for name, value in statistics.items():
+                counters[f'single_flight.{provider}.{name}'] = value
+        counters['http.requests'] = sum(
+            stats['requests'] for stats in get_http_pool().get_statistics().values())
+        return counters
+
     def _runSearch(self, s=''):
         searchnumber = []
-        self.namesNotFound = get_names_not_found(
-            self.prefs['name_not_found_file'])
-        self.calldict = FritzCalls(
-            days_back=7, namesNotFound=self.namesNotFound).calldict
+        ioCounters = self._get_io_counters()
+        self.namesNotFound.reload_if_changed()
+        if self.fritzCalls is None:
+            self.fritzCalls = FritzCalls(
+                days_back=7, connection=self.connection, namesNotFound=self.namesNotFound, prefs=self.prefs)
+        else:
+            self.fritzCalls.refresh()
+        self.calldict = self.fritzCalls.calldict
         # add search numbers provided via cli
-        if args.searchnumber:
-            if isinstance(args.searchnumber, tuple):
-                searchnumber += args.searchnumber
+        if self.args.searchnumber:
+            if isinstance(self.args.searchnumber, tuple):
+                searchnumber += self.args.searchnumber
             else:
-                searchnumber.append(args.searchnumber)
+                searchnumber.append(self.args.searchnumber)
         # add search numbers provided via parameter
         if s:
             if isinstance(s, tuple):
@@ -166,20 +247,30 @@ class FritzBackwardSearch():
                         new.Name = number
                         self.calldict.append(new)
                 else:
-                    for realName in contact['contact'].iter('realName'):
-                        logger.info(
-                            '%s = %s(%s)',
-                            number,
-                            args.phonebook,
-                            realName.text.replace('&amp;', '&'),
-                        )
+                    logger.info(
+                        '%s = %s(%s)',
+                        number,
+                        self.args.phonebook,
+                        contact.name,
+                    )
         else:
             logger.error("Searchnumber nicht gesetzt")
 
-        knownCallers = self._get_names()
-        set_names_not_found(
-            self.prefs['name_not_found_file'], self.namesNotFound)
+        knownCallers, lookupFailed = self._get_names()
+        logger.debug('lookup cache %s', self.lookupCache.get_statistics())
+        logger.debug('lookup providers %s', self.lookupChain.get_statistics())
+        logger.debug('http pool %s', get_http_pool().get_statistics())
         self.phonebook.add_entry_list(knownCallers)
+        # the calls only count as processed now, after an error or a failed lookup
+        # the next search fetches them again
+        if lookupFailed:
+            logger.warning('Lookups failed, the calls will be searched again')
+        else:
+            self.fritzCalls.commit()
+        logger.info('I/O of search: %s', {
+            name: value - ioCounters.get(name, 0)
+            for name, value in self._get_io_counters().items()
+            if value != ioCounters.get(name, 0)})
 
     # ---------------------------------------------------------
     # cli-section:
@@ -1,47 +1,61 @@
-import datetime
+import asyncio
 import logging
 import os
 import socket
 import sys
-import threading
-import time
-from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 
 # import root directory into python module search path
 sys.path.insert(1, os.getcwd())  # noqa
 
 from fritzconnection import FritzConnection
 
+from callMonitorBus import CallMonitorBus
+from callMonitorEvent import CALL, CONNECT, DISCONNECT, RING, parse_event
+from callMonitorReader import open_call_monitor, read_lines
 from fritzBackwardSearch import FritzBackwardSearch
 from fritzCallsDuringAbsense import FritzCallsDuringAbsense
 from logs import get_logger
-from prefs import read_configuration
+from prefs import get_box_names, read_configuration
 
 """
 Fritzbox Call Monitor
 
 Adopted from here: http://dede67.bplaced.net/PhythonScripte/callmon/callmon.html
 
- - The thread (worker1) receives the CallMonitor messages from the Fritzbox and writes them to the fb_queue.
+ - The server monitors the Fritzbox configured in the DEFAULT section of fritzBackwardSearch.ini or every Fritzbox
+   configured in a [box:name] section. The settings of a box not given in its section are taken from the DEFAULT section.
+   The boxes share the lookup cache, the list of names not found, the area code index, the HTTP pool and the rate limit
+   of the reverse lookup, every box has its own CallMonBox with its own connection and tasks.
 
- - The thread (worker2) receives from the fb_queue and calls the FritzBackwardSearch class, which updates the Fritzbox phonebook
+ - The server runs an asyncio event loop with the following tasks per box:
+    - runFritzboxCallMonitor() receives the CallMonitor messages from the Fritzbox line by line, parses each line once into
+      a CallMonitorEvent and publishes it on the CallMonitorBus, which passes the same event to every subscriber.
+    - runFritzBackwardSearch() receives from its subscription and calls the FritzBackwardSearch class, which updates the Fritzbox phonebook
+    - runFritzCallsDuringAbsense() receives from its subscription and collects the calls not having been accepted
+    - runAbsenseReconciler() looks up the calls not having been accepted in the call list of the Fritzbox as soon as
+      they are due. It is woken up by runFritzCallsDuringAbsense() and waits with exponential backoff until the
+      answering machine entry shows up, fetching the call list once for all waiting callers.
+
+ - The blocking TR-064 and HTTP work of FritzBackwardSearch and FritzCallsDuringAbsense runs in an executor
+   with one thread per consumer, so the calls of a consumer are still processed one after the other.
 
  - The message from the Fritzbox has the following flow:
-   	- Message is received in thread runFritzboxCallMonitor()
-   	- Message gets passed via self.fb_queue to the thread runFritzBackwardSearch()
-   	- Message is received in runFritzBackwardSearch()
-	 	- split message
-	 	- call of the FritzBackwardSearch instance with passing the caller number
+   	- Message is received in task runFritzboxCallMonitor() and parsed into a CallMonitorEvent
+   	- Event gets passed via the bounded queue of its subscription to the task runFritzBackwardSearch()
+   	- Event is received in runFritzBackwardSearch()
+	 	- call of the FritzBackwardSearch instance with passing the number of the other party
 	- Message is received in runFritzCallsDuringAbsense()
 		- if incoming call has't been accepted a pushover message with the callers name, number and phonemessage will be sent
 """
 
 
-class CallMonServer():
+class CallMonBox():
 
-    def __init__(self):
+    def __init__(self, prefs):
         self.logger = logging.getLogger()
-        self.prefs = read_configuration()
+        self.prefs = prefs
+        self.name = prefs.get('box', prefs['fritz_ip_address'])
         self.run()
         super().__init__()
 
@@ -50,141 +64,178 @@ class CallMonServer():
 
         # initialize FB connection
         if self.prefs['password'] == '':
-            self.logger.error('No password given')
+            self.logger.error('No password given for %s', self.name)
             sys.exit(1)
         self.connection = FritzConnection(
             address=self.prefs['fritz_ip_address'],
             port=self.prefs['fritz_tcp_port'],
             user=self.prefs['fritz_username'],
             password=self.prefs['password'])
-        # Meldungs-Übergabe von runFritzboxCallMonitor() an runFritzBackwardSearch()
-        self.fb_queue = Queue()
-        self.fb_absense_queue = Queue()
-
-        self.FBS = FritzBackwardSearch()
-        self.FCDA = FritzCallsDuringAbsense(self.connection)
-        self.startFritzboxCallMonitor()
 
-    # self.FCDA.set_unresolved('01772429352')
+        self.FBS = FritzBackwardSearch(self.connection, prefs=self.prefs)
+        self.FCDA = FritzCallsDuringAbsense(self.connection, prefs=self.prefs)
+        # one thread per consumer for the blocking TR-064 calls
+        self.fbs_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='runFritzBackwardSearch')
+        self.fcda_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='runFritzCallsDuringAbsense')
+        self.bus = CallMonitorBus(
+            maxsize=int(self.prefs.get('callmon_queue_size', 1000)),
+            policy=self.prefs.get('callmon_queue_policy', 'drop_oldest'))
 
     # ###########################################################
-    # Empfangs-Thread und Verarbeitungs-Thread aufsetzen.
-    # Funktion verändert:
-    #   startet zwei Threads
+    # Empfangs-Task und Verarbeitungs-Tasks aufsetzen.
     # ###########################################################
-    def startFritzboxCallMonitor(self):
-        worker1 = threading.Thread(
-            target=self.runFritzboxCallMonitor, name="runFritzboxCallMonitor")
-        worker1.daemon = True
-        worker1.start()
-
-        worker2 = threading.Thread(
-            target=self.runFritzBackwardSearch, name="runFritzBackwardSearch")
-        worker2.daemon = True
-        worker2.start()
-
-        worker3 = threading.Thread(
-            target=self.runFritzCallsDuringAbsense, name="runFritzCallsDuringAbsense")
-        worker3.daemon = True
-        worker3.start()
+    async def startFritzboxCallMonitor(self):
+        # Meldungs-Übergabe von runFritzboxCallMonitor() an die Abonnenten des Bus
+        fbs_subscription = self.bus.subscribe('runFritzBackwardSearch')
+        fcda_subscription = self.bus.subscribe('runFritzCallsDuringAbsense')
+        self.absense_wakeup = asyncio.Event()
+
+        await asyncio.gather(
+            self.runFritzboxCallMonitor(),
+            self.runFritzBackwardSearch(fbs_subscription),
+            self.runFritzCallsDuringAbsense(fcda_subscription),
+            self.runAbsenseReconciler(),
+        )
 
     # ###########################################################
-    # Running as Thread.
-    # Make connection to Fritzbox, receive messages from the Fritzbox and pass over to queue
+    # Running as Task.
+    # Make connection to Fritzbox, receive messages from the Fritzbox and publish them on the bus
     # ###########################################################
-    def runFritzboxCallMonitor(self):
+    async def runFritzboxCallMonitor(self):
         while True:  # Socket-Connect-Loop
-            self.recSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             try:
-                self.recSock.connect(
-                    (self.prefs['fritz_ip_address'], int(self.prefs['fritz_callmon_port'])))
+                reader, writer = await open_call_monitor(
+                    self.prefs['fritz_ip_address'], int(self.prefs['fritz_callmon_port']))
             except socket.herror as e:
                 self.logger.error("socket.herror %s", e)
-                time.sleep(10)
+                await asyncio.sleep(10)
                 continue
             except socket.gaierror as e:
                 self.logger.error("socket.gaierror %s", e)
-                time.sleep(10)
+                await asyncio.sleep(10)
                 continue
             except socket.timeout as e:
                 self.logger.error("socket.timeout %s", e)
                 continue
             except socket.error as e:
                 self.logger.error("socket.error %s", e)
-                time.sleep(10)
+                await asyncio.sleep(10)
                 continue
             except Exception as e:
                 self.logger.error("%s", e)
-                time.sleep(10)
+                await asyncio.sleep(10)
                 continue
             self.logger.info(
-                "The connection to the Fritzbox call monitor has been established!")
+                "The connection to the Fritzbox call monitor of %s has been established!", self.name)
 
-            while True:  # Socket-Receive-Loop
-                try:
-                    ln = self.recSock.recv(256).strip()
-                except:
-                    ln = ""
-
-                if ln != "":
-                    self.fb_queue.put(ln)
-                    self.fb_absense_queue.put(ln)
-                else:
-                    self.logger.info(
-                        "The connection to the Fritzbox call monitor has been stopped!")
-                    self.fb_queue.put("CONNECTION_LOST")
-                    break   # back to the Socket-Connect-Loop
+            # Socket-Receive-Loop, one message per line
+            async for ln in read_lines(reader):
+                event = parse_event(ln)
+                if event is None:
+                    continue
+                await self.bus.publish(event)
+            self.logger.info(
+                "The connection to the Fritzbox call monitor of %s has been stopped!", self.name)
+            self.logger.debug('Call monitor bus of %s %s', self.name, self.bus.get_statistics())
+            await self.bus.publish("CONNECTION_LOST")
+            writer.close()
+            # back to the Socket-Connect-Loop
 
     # ###########################################################
-    # Running as Thread.
+    # Running as Task.
     # Make connection to Fritzbox, do backwardsearch for callers number
     # ###########################################################
-    def runFritzBackwardSearch(self):
-        while True:
-            time.sleep(0.01)
-            msgtxt = self.fb_queue.get()
-            if not (msgtxt in ("CONNECTION_LOST", "REFRESH")):
-                msg = msgtxt.decode().split(';')
-                if msg[1] == "RING":
-                    self.FBS._runSearch(s=msg[3])
-                if msg[1] == "CALL":
-                    self.FBS._runSearch(s=msg[5])
+    async def runFritzBackwardSearch(self, subscription):
+        loop = asyncio.get_running_loop()
+        async for event in subscription:
+            if event in ("CONNECTION_LOST", "REFRESH"):
+                continue
+            if event.type in (RING, CALL):
+                try:
+                    await loop.run_in_executor(self.fbs_executor, self.FBS._runSearch, event.number)
+                except Exception:
+                    self.logger.error('Error in runFritzBackwardSearch', exc_info=True)
 
     # ###########################################################
-    # Running as Thread.
+    # Running as Task.
     # Make connection to Fritzbox and retrieve the answering machine message, and inform via Pushover
     # ###########################################################
-    def runFritzCallsDuringAbsense(self):
+    async def runFritzCallsDuringAbsense(self, subscription):
+        loop = asyncio.get_running_loop()
         call_history = {}
-        while True:
-            time.sleep(0.01)
-            msgtxt = self.fb_absense_queue.get()
-            self.logger.info(msgtxt)
-            if not (msgtxt in ("CONNECTION_LOST", "REFRESH")):
-                # RING;ID;CALLER;CALLED;
-                # CONNECT;ID;PORT;CALLER;
-                # DISCONNECT;ID;SECONDS;
-                call_type, call_id, caller_or_port = msgtxt.decode().split(';')[
-                    1:4]
-                if call_type == "RING":
-                    call_history[call_id] = caller_or_port
+        async for event in subscription:
+            if event == "CONNECTION_LOST":
+                # the calls in progress will never be finished
+                call_history.clear()
+                continue
+            if event == "REFRESH":
+                continue
+            self.logger.info(event)
+            call_id = event.connection_id
+            try:
+                if event.type == RING:
+                    call_history[call_id] = event
                     self.logger.info(call_history)
-                elif call_type == "CONNECT":
+                elif event.type == CONNECT:
                     self.logger.info(call_history)
                     if call_id in call_history:
                         del call_history[call_id]
-                elif call_type == "DISCONNECT":
+                elif event.type == DISCONNECT:
                     if call_id in call_history:
                         self.logger.info(call_history)
-                        self.logger.info('calling FCDA %s',
-                                         call_history[call_id])
-                        self.FCDA.set_unresolved(call_history[call_id])
+                        ring = call_history[call_id]
+                        self.logger.info('calling FCDA %s', ring.caller)
+                        await loop.run_in_executor(
+                            self.fcda_executor, self.FCDA.set_unresolved, ring.caller, ring.timestamp)
                         del call_history[call_id]
+                        self.absense_wakeup.set()
+            except Exception:
+                self.logger.error('Error in runFritzCallsDuringAbsense', exc_info=True)
+
+    # ###########################################################
+    # Running as Task.
+    # Check the calls not having been accepted when they are due or a new one has been added
+    # ###########################################################
+    async def runAbsenseReconciler(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self.absense_wakeup.wait(), self.FCDA.next_check())
+            except asyncio.TimeoutError:
+                pass
+            self.absense_wakeup.clear()
+            try:
+                await loop.run_in_executor(self.fcda_executor, self.FCDA.get_unresolved)
+            except Exception:
+                self.logger.error('Error in runAbsenseReconciler', exc_info=True)
+
+
+class CallMonServer():
+
+    def __init__(self):
+        self.logger = logging.getLogger()
+        self.prefs = read_configuration()
+        self.run()
+        super().__init__()
+
+    def run(self):
+        self.logger = get_logger()
+        names = get_box_names()
+        if names:
+            self.boxes = [CallMonBox(read_configuration(name)) for name in names]
+        else:
+            self.boxes = [CallMonBox(self.prefs)]
+
+    async def startBoxes(self):
+        await asyncio.gather(*(box.startFritzboxCallMonitor() for box in self.boxes))
 
     # ###########################################################
     # Start fritzCallMon Server
     # ###########################################################
     def runServer(self):
+        # the server socket prevents a second instance from being started
         self.srvSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.srvSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         try:
@@ -195,18 +246,11 @@ class CallMonServer():
                               self.prefs['callmon_server_socket'], e)
             return
         self.logger.info('%s has been started', __class__.__name__)
-        while True:
-            try:
-                self.srvSock.listen(5)
-                time.sleep(0.01)
-            except Exception:
-                self.logger.info('has been stopped')
-                sys.exit()
-
-            now = datetime.datetime.now()
-            if now.minute % 1 == 0 and now.second == 0:
-                self.FCDA.get_unresolved()
-                time.sleep(1)
+        try:
+            asyncio.run(self.startBoxes())
+        except KeyboardInterrupt:
+            self.logger.info('has been stopped')
+            sys.exit()
 
 
 if __name__ == '__main__':
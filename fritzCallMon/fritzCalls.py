@@ -1,48 +1,71 @@
 # -*- coding: utf-8 -*-
 
+import json
 import logging
 import os
 import sys
+import threading
+import time
+from xml.etree.ElementTree import fromstring
 
 # import root directory into python module search path
 sys.path.insert(1, os.getcwd())  # noqa
 
 
 from fritzconnection import FritzConnection
-from fritzconnection.lib.fritzcall import FritzCall
+from fritzconnection.lib.fritzcall import Call, FritzCall
 
+from httpPool import get_http_pool
 from logs import get_logger
+from namesNotFound import DAY, NamesNotFound
 from prefs import read_configuration
 
 logger = logging.getLogger(__name__)
 
 
-def get_names_not_found(path):
+_names_not_found = {}
+_names_not_found_lock = threading.Lock()
+
+
+def get_names_not_found(path, ttl=0):
+    """
+    Returns the process wide NamesNotFound list of the given file
+    """
+    with _names_not_found_lock:
+        namesNotFound = _names_not_found.get(path)
+        if namesNotFound is None:
+            namesNotFound = _names_not_found[path] = NamesNotFound(path, ttl=ttl)
+        return namesNotFound
+
+
+def get_call_list_state(path):
     try:
         with open(path, encoding='utf-8', mode='r') as file:
-            namesNotFound = file.read().splitlines()
-    except:
-        with open(path, encoding='utf-8', mode='w+') as file:
-            namesNotFound = file.read().splitlines()
-    return namesNotFound
+            return json.load(file)
+    except (OSError, ValueError):
+        return {'id': None, 'full': 0}
 
 
-def set_names_not_found(path, new_list):
-    nameNotFoundList_length = len(get_names_not_found(path))
-    if len(new_list) > nameNotFoundList_length:
-        with open(path, encoding='utf-8', mode="w") as outfile:
-            outfile.write("\n".join(new_list))
+def set_call_list_state(path, state):
+    tmp = path + '.tmp'
+    with open(tmp, encoding='utf-8', mode='w') as file:
+        json.dump(state, file)
+    os.replace(tmp, path)
 
 
 class FritzCalls():
     """
     Returns a list of caller dicts not having a name and not being listed in the given namesNotFound list
+    Only calls newer than the last processed call are fetched. The whole call list
+    of the last days_back days is reconciled periodically. The fetched calls only count
+    as processed once commit() has been called.
     """
 
-    def __init__(self, days_back=7, connection=None, namesNotFound=None):
+    def __init__(self, days_back=7, connection=None, namesNotFound=None, incremental=True, prefs=None):
         self.days_back = days_back
+        self.incremental = incremental
         self.logger = get_logger()
-        self.prefs = read_configuration()
+        self.prefs = prefs or read_configuration()
         if connection:
             self.connection = connection
         else:
@@ -56,13 +79,81 @@ class FritzCalls():
             self.namesNotFound = namesNotFound
         else:
             self.namesNotFound = get_names_not_found(
-                self.prefs['name_not_found_file'])
+                self.prefs['name_not_found_file'],
+                ttl=float(self.prefs.get('name_not_found_ttl', 0)) * DAY)
         self.calldict = []
+        self.stateFile = self.prefs.get('call_list_state_file') or os.path.join(
+            os.path.dirname(self.prefs['name_not_found_file']), 'callList.state')
+        if 'box' in self.prefs:
+            # the call ids are counted on every box, so every box keeps its own state
+            root, ext = os.path.splitext(self.stateFile)
+            self.stateFile = f"{root}.{self.prefs['box']}{ext}"
+        self.fullInterval = float(self.prefs.get('call_list_full_interval', 86400))
+        self.statistics = {'full_fetches': 0, 'incremental_fetches': 0, 'state_reads': 0, 'state_writes': 0}
+        self.state = None
+        self.pending = None
         self.logger.info('%s has been started', __class__.__name__)
         self._get_unknown()
 
+    def refresh(self):
+        """
+        Fetch the calls again, keeping the state of the last processed call in memory
+        """
+        self.calldict = []
+        self._get_unknown()
+        return self.calldict
+
+    def _get_calls(self):
+        if self.state is None:
+            self.state = get_call_list_state(self.stateFile)
+            self.statistics['state_reads'] += 1
+        # the new state is kept until the calls have been processed, see commit()
+        state = dict(self.state)
+        if not self.incremental or state['id'] is None or time.time() - state['full'] >= self.fullInterval:
+            calls = FritzCall(fc=self.connection).get_calls(days=self.days_back)
+            state['full'] = time.time()
+            self.statistics['full_fetches'] += 1
+        else:
+            calls = self._get_new_calls(int(state['id']))
+            self.statistics['incremental_fetches'] += 1
+        ids = [int(call.Id) for call in calls if call.Id is not None and call.Id.isdigit()]
+        if ids:
+            state['id'] = max(ids + [int(state['id'] or 0)])
+        self.pending = state
+        return calls
+
+    def commit(self):
+        """
+        Save the id of the last fetched call once the calls have been processed. Without
+        a commit the next refresh fetches the same calls again.
+        """
+        if self.pending is None:
+            return
+        self.state, self.pending = self.pending, None
+        if self.incremental:
+            try:
+                set_call_list_state(self.stateFile, self.state)
+                self.statistics['state_writes'] += 1
+            except OSError:
+                logger.error('Cannot save %s', self.stateFile, exc_info=True)
+
+    def _get_new_calls(self, last_id):
+        # the box only returns calls with an id higher than the given one
+        url = self.connection.call_action(
+            'X_AVM-DE_OnTel', 'GetCallList')['NewCallListURL']
+        response = get_http_pool(self.prefs).request(
+            'GET', f'{url}&days={self.days_back}&id={last_id}')
+        calls = []
+        for node in fromstring(response.data).iter('Call'):
+            call = Call()
+            for item in node:
+                setattr(call, item.tag, item.text)
+            if getattr(call, 'Id', None) and call.Id.isdigit() and int(call.Id) > last_id:
+                calls.append(call)
+        return calls
+
     def _get_unknown(self):  # get list of callers not listed with their name
-        for call_dict in FritzCall(fc=self.connection).get_calls(days=self.days_back):
+        for call_dict in self._get_calls():
             if call_dict.Id is None or call_dict.Caller is None:
                 continue
             if call_dict.Name and not call_dict.Name.isdigit() and not '(' in call_dict.Name:
@@ -86,6 +177,6 @@ class FritzCalls():
 
 
 if __name__ == '__main__':
-    FC = FritzCalls(days_back=7, namesNotFound=[])
+    FC = FritzCalls(days_back=7, namesNotFound=[], incremental=False)
     for call in FC.calldict:
         print(call)
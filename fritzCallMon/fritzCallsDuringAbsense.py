@@ -1,34 +1,44 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import http.client
+import datetime
 import logging
 import os
 import re
 import sys
-import urllib
-
-import speech_recognition as sr
-import urllib3
+import threading
+import time
+import urllib.parse
 
 # import root directory into python module search path
 sys.path.insert(1, os.getcwd())  # noqa
 
 from fritzconnection.lib.fritzcall import FritzCall
 
+from audioPreprocessor import AudioPreprocessor
+from httpPool import get_http_pool
 from logs import get_logger
 from prefs import read_configuration
+from transcriber import Transcriber, get_recognizer
 
 logger = logging.getLogger(__name__)
 
+DOWNLOAD_CHUNK = 64 * 1024
+
 
 class FritzCallsDuringAbsense():
 
-    def __init__(self, connection):
+    def __init__(self, connection, prefs=None):
         self.logger = None
-        self.prefs = read_configuration()
+        self.prefs = prefs or read_configuration()
         self.connection = connection
-        self.unresolved_list = []
+        # caller -> {'since', 'attempts', 'next'} of the calls waiting for their call list entry
+        self.unresolved = {}
+        self.lock = threading.Lock()
+        self.checkDelay = float(self.prefs.get('absence_check_delay', 10))
+        self.checkMaxDelay = float(self.prefs.get('absence_check_max_delay', 300))
+        self.checkTimeout = float(self.prefs.get('absence_check_timeout', 86400))
+        self.statistics = {'call_list_fetches': 0, 'notifications': 0, 'expired': 0}
         self.run()
         super().__init__()
 
@@ -38,12 +48,26 @@ class FritzCallsDuringAbsense():
 
         self.areaCode = (self.connection.call_action(
             'X_VoIP', 'GetVoIPCommonAreaCode'))['NewVoIPAreaCode']
-        self.http = urllib3.PoolManager()
+        self.http = get_http_pool(self.prefs)
+        # the address of the box is usually given without scheme
+        address = self.prefs['fritz_ip_address']
+        self.boxURL = address if '://' in address else f'http://{address}'
+        # the boxes use the same names for their phone messages
+        self.phoneMsgDir = os.path.join(self.prefs['phone_msg_dir'], self.prefs.get('box', ''))
         self.callURLList = self.connection.call_action(
             'X_AVM-DE_OnTel', 'GetCallList')
         entries = re.search("sid=(.*)$", self.callURLList['NewCallListURL'])
         self.sid = entries.group(0)
         self.FC = FritzCall(fc=self.connection)
+        self.transcriber = Transcriber(
+            get_recognizer(self.prefs.get('speech_recognizer', 'google'), self.prefs.get('speech_language', 'de-DE')),
+            workers=int(self.prefs.get('speech_workers', 2)),
+            retries=int(self.prefs.get('speech_retries', 5)),
+            preprocessor=AudioPreprocessor(
+                threshold=int(self.prefs.get('audio_silence_threshold', 500)),
+                sample_rate=int(self.prefs.get('audio_sample_rate', 8000)),
+                chunk_seconds=float(self.prefs.get('audio_chunk_seconds', 30)),
+            ) if self.prefs.get('audio_preprocess', False) else None)
 
     def get_sid(self):
         return self.sid
@@ -53,32 +77,101 @@ class FritzCallsDuringAbsense():
             return code
         return self.areaCode + code
 
-    def set_unresolved(self, caller):
-        self.unresolved_list.append(caller)
+    def set_unresolved(self, caller, ring=None):
+        """
+        Waits for the call list entry of the caller, ring is the time of the RING event
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.unresolved.setdefault(
+                caller, {'since': now, 'ring': ring, 'attempts': 0, 'next': now + self.checkDelay})
+
+    def _is_since(self, call, ring):
+        # the call list has the minute of the call only
+        if ring is None:
+            return True
+        try:
+            return datetime.datetime.strptime(call.Date, '%d.%m.%y %H:%M') >= ring.replace(second=0, microsecond=0)
+        except (TypeError, ValueError):
+            return True
+
+    def next_check(self):
+        """
+        Returns the seconds until the next caller is due, None if no caller is waiting
+        """
+        with self.lock:
+            if not self.unresolved:
+                return None
+            return max(0, min(state['next'] for state in self.unresolved.values()) - time.monotonic())
 
     def get_unresolved(self):
-        for caller in self.unresolved_list:
-            # calls = [
-            # call for call in self.FC.get_calls(update=True, days=5)
-            # if call.Type == "1" and call.Port == "40" and call.Path and call.Caller in caller]
-            calls = [
-                call for call in self.FC.get_calls(update=True, days=5)
-                if call.Type == "1" and call.Port == "40" and call.Caller in caller]
-            calls += [
-                call for call in self.FC.get_missed_calls(update=True, days=3)
-                if call.Type == "2" and call.Caller and call.Caller in caller]
-            calls = sorted(calls, key=lambda x: x.Date, reverse=True)
-            for call in calls:
-                self.process_notification(call)
-                self.unresolved_list.remove(call.Caller)
-                break
+        """
+        Downloads the call list once for all due callers and notifies the callers found in it.
+        Callers not found yet are checked again with exponential backoff.
+        """
+        now = time.monotonic()
+        with self.lock:
+            due = [caller for caller, state in self.unresolved.items() if state['next'] <= now]
+        if not due:
+            return
+        try:
+            index = self._get_call_index()
+        except Exception:
+            # check again after the backoff delay
+            logger.error('Error getting the call list', exc_info=True)
+            index = {}
+        for caller in due:
+            calls = index.get(caller)
+            if calls is None:
+                # the call list may hold the number without the prefix used by the call monitor
+                calls = [call for number, calls in index.items() if number in caller for call in calls]
+            with self.lock:
+                state = self.unresolved[caller]
+                # the earlier calls of the caller are in the call list as well
+                calls = [call for call in calls if self._is_since(call, state['ring'])]
+                if calls:
+                    del self.unresolved[caller]
+                elif now - state['since'] > self.checkTimeout:
+                    del self.unresolved[caller]
+                    self.statistics['expired'] += 1
+                    logger.warning('No call list entry found for %s, giving up', caller)
+                else:
+                    state['attempts'] += 1
+                    state['next'] = now + min(self.checkDelay * 2 ** state['attempts'], self.checkMaxDelay)
+            if calls:
+                self.statistics['notifications'] += 1
+                # the call list is sorted newest first
+                self.process_notification(calls[0])
+
+    def _get_call_index(self):
+        # received calls answered by the answering machine and missed calls by caller number
+        index = {}
+        self.statistics['call_list_fetches'] += 1
+        for call in self.FC.get_calls(update=True, days=5):
+            if call.Caller and (call.Type == "1" and call.Port == "40" or call.Type == "2"):
+                index.setdefault(call.Caller, []).append(call)
+        return index
 
     def process_notification(self, call):
-        phone_message = self.get_phone_message(call)
+        # notify at once, the transcript of the phone message follows when it is ready
+        filename = self.get_phone_message(call)
+        self.pushover(self.get_message(call, ''))
+        if filename:
+            self.transcriber.submit(
+                filename, lambda phone_message, error: self.process_transcript(call, phone_message, error))
+
+    def process_transcript(self, call, phone_message, error):
+        if error is not None:
+            self.pushover(f'Error in speech_to_text {error}')
+            return
         logger.info("phone_message=%s", phone_message)
-        self.pushover(self.get_message(call, phone_message))
+        if phone_message:
+            self.pushover(self.get_message(call, phone_message))
 
     def get_phone_message(self, call):
+        """
+        Downloads the phone message of the call, returns the name of the WAV file or ""
+        """
         phone_message = ""
         # if it is a phone message
         if hasattr(call, 'Path') and call.Path:
@@ -87,34 +180,71 @@ class FritzCallsDuringAbsense():
                 entries = re.search("(path=)(.*)", call.Path)
                 dlpath = entries.group(2)
                 dlfile = dlpath.split("/")
-                response = self.http.request(
-                    'GET',
-                    f'{self.prefs["fritz_ip_address"]}/lua/photo.lua?{self.get_sid()}&myabfile={dlpath}'
-                )
-                if not os.path.exists(self.prefs['phone_msg_dir']):
-                    os.makedirs(self.prefs['phone_msg_dir'])
-                with open(os.path.join(self.prefs['phone_msg_dir'], f'{dlfile[-1]}.wav'), 'wb') as wave:
-                    wave.write(response.data)
-                    phone_message = self.speech_to_text(wave.name)
+                if not os.path.exists(self.phoneMsgDir):
+                    os.makedirs(self.phoneMsgDir)
+                phone_message = os.path.join(self.phoneMsgDir, f'{dlfile[-1]}.wav')
+                if self._is_downloaded(phone_message, call):
+                    logger.info('%s has already been downloaded', phone_message)
+                else:
+                    self.download_phone_message(dlpath, phone_message)
             except Exception as e:
+                phone_message = ""
                 logger.error('Error in get_phone_message %s', e)
                 self.pushover(f'Error in get_phone_message {e}')
         return phone_message
 
+    def _is_downloaded(self, filename, call):
+        # the Fritzbox reuses the path of deleted phone messages, an older file belongs to an earlier call
+        try:
+            mtime = os.path.getmtime(filename)
+        except OSError:
+            return False
+        try:
+            return mtime >= datetime.datetime.strptime(call.Date, '%d.%m.%y %H:%M').timestamp()
+        except (TypeError, ValueError):
+            return True
+
+    def download_phone_message(self, dlpath, filename):
+        """
+        Streams the phone message in chunks to a temporary file, which is renamed to filename
+        when the number of bytes matches the Content-Length
+        """
+        response = self.http.request(
+            'GET',
+            f'{self.boxURL}/lua/photo.lua?{self.get_sid()}&myabfile={dlpath}',
+            preload_content=False)
+        tmp = filename + '.part'
+        try:
+            if response.status != 200:
+                raise IOError(f'HTTP status {response.status}')
+            size = 0
+            with open(tmp, 'wb') as wave:
+                for chunk in response.stream(DOWNLOAD_CHUNK):
+                    wave.write(chunk)
+                    size += len(chunk)
+            length = response.headers.get('Content-Length')
+            if length is not None and int(length) != size:
+                raise IOError(f'{size} of {length} bytes received')
+            os.replace(tmp, filename)
+            logger.debug('%s downloaded, %s bytes', filename, size)
+        finally:
+            response.release_conn()
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
     def pushover(self, message):
         if self.prefs['pushover_token'] and self.prefs['pushover_userkey']:
             retry_count = 5
             retry = True
             while retry and retry_count > 0:
                 try:
-                    conn = http.client.HTTPSConnection("api.pushover.net:443")
-                    conn.request("POST", "/1/messages.json",
-                                 urllib.parse.urlencode({
-                                     "token": self.prefs['pushover_token'],
-                                     "user": self.prefs['pushover_userkey'],
-                                     "message": message,
-                                 }), {"Content-type": "application/x-www-form-urlencoded"})
-                    conn.getresponse()
+                    self.http.request(
+                        "POST", "https://api.pushover.net/1/messages.json",
+                        body=urllib.parse.urlencode({
+                            "token": self.prefs['pushover_token'],
+                            "user": self.prefs['pushover_userkey'],
+                            "message": message,
+                        }), headers={"Content-type": "application/x-www-form-urlencoded"})
                     retry = False
                 except Exception:
                     retry_count -= 1
@@ -132,23 +262,3 @@ class FritzCallsDuringAbsense():
                 phone_message,
             )
         return text
-
-    def speech_to_text(self, filename):
-        retry_count = 5
-        retry = True
-        while retry and retry_count > 0:
-            try:
-                # initialize the recognizer
-                r = sr.Recognizer()
-                # open the file
-                with sr.AudioFile(filename) as source:
-                    # listen for the data (load audio to memory)
-                    audio_data = r.record(source)
-                    # recognize (convert from speech to text)
-                    text = r.recognize_google(audio_data, language="de-DE")
-                    return text
-                retry = False
-            except Exception as e:
-                retry_count -= 1
-                logger.error('Error in speech_to_text %s', e)
-                self.pushover(f'Error in speech_to_text {e}')
@@ -2,23 +2,24 @@
 
 import argparse
 import copy
-import html.parser
+import html
+import itertools
 import logging
 import os
-import re
 import sys
+import threading
+import time
 from xml.etree.ElementTree import fromstring, tostring
 
-import certifi
-import urllib3
-
 # import root directory into python module search path
 sys.path.insert(1, os.getcwd())  # noqa
 
 from fritzconnection import FritzConnection
 from fritzconnection.lib.fritzphonebook import FritzPhonebook
 
+from httpPool import get_http_pool
 from logs import get_logger
+from phonebookParser import PhonebookContact, PhonebookParser, parse_phonebook
 from prefs import read_configuration
 
 logger = logging.getLogger(__name__)
@@ -28,11 +29,15 @@ args = argparse.Namespace()
 args.logfile = ''
 
 
+def _normalize_number(number):
+    return ''.join(filter(str.isdigit, number))
+
+
 class MyFritzPhonebook():
 
-    def __init__(self, connection=None, name=None):
+    def __init__(self, connection=None, name=None, prefs=None):
         self.logger = None
-        self.prefs = read_configuration()
+        self.prefs = prefs or read_configuration()
         if connection:
             self.connection = connection
         else:
@@ -46,7 +51,21 @@ class MyFritzPhonebook():
             name = self.prefs['fritz_phone_book']
         self.fritzphonebook = FritzPhonebook(self.connection)
         self.bookNumber = None
-        self.phonebookEntries = None
+        self.index = {'name': {}, 'number': {}, 'uid': {}, 'contact_id': {}}
+        self.refreshInterval = float(self.prefs.get('phonebook_refresh_interval', 3600))
+        self.lastRefresh = 0
+        self.timestamp = None
+        self.statistics = {
+            'full_downloads': 0, 'unchanged_downloads': 0, 'entry_fetches': 0, 'entry_writes': 0}
+        self.batchDownloads = 0
+        # write-behind queue of numbers to be added, grouped by name
+        self.pending = {}
+        self.pendingNumbers = 0
+        self.flushSize = int(self.prefs.get('phonebook_flush_size', 20))
+        self.flushInterval = float(self.prefs.get('phonebook_flush_interval', 0))
+        self.writeRetries = int(self.prefs.get('phonebook_write_retries', 3))
+        self.flushTimer = None
+        self.lock = threading.RLock()
         self.run(name)
         super().__init__()
 
@@ -66,91 +85,220 @@ class MyFritzPhonebook():
             sys.exit(1)
         self.get_phonebook()
 
-    def get_phonebook(self):
-        http = urllib3.PoolManager(
-            cert_reqs='CERT_REQUIRED', ca_certs=certifi.where())
-        response = http.request('GET', self.connection.call_action(
-            'X_AVM-DE_OnTel', 'GetPhonebook', NewPhonebookID=self.bookNumber)['NewPhonebookURL'])
-        self.phonebookEntries = fromstring(
-            re.sub("!-- idx:(\d+) --", lambda m: "idx>"+m.group(1)+"</idx", response.data.decode("utf-8")))
+    def get_phonebook(self, only_if_changed=False):
+        url = self.connection.call_action(
+            'X_AVM-DE_OnTel', 'GetPhonebook', NewPhonebookID=self.bookNumber)['NewPhonebookURL']
+        if only_if_changed and self.timestamp:
+            # the box only returns the phonebook if it has been changed since the given timestamp
+            url += f'&timestamp={self.timestamp}'
+        response = get_http_pool(self.prefs).request('GET', url, preload_content=False)
+        try:
+            chunks = response.stream(65536)
+            first = next(chunks, b'')
+            if only_if_changed and self.timestamp and b'<phonebook' not in first:
+                self.lastRefresh = time.monotonic()
+                self.statistics['unchanged_downloads'] += 1
+                return
+            # the phonebook is parsed while it is downloaded, only compact contact records are kept.
+            # The index is replaced once the download is complete, a broken one keeps the former index
+            parser = PhonebookParser()
+            index = self._build_index(parse_phonebook(itertools.chain((first, ), chunks), parser))
+            self.index, self.timestamp = index, parser.timestamp
+            self.lastRefresh = time.monotonic()
+            self.statistics['full_downloads'] += 1
+            self.batchDownloads += 1
+        finally:
+            response.release_conn()
+
+    def refresh_phonebook(self):
+        # full refresh only on timer, local changes are applied to the in-memory phonebook
+        if time.monotonic() - self.lastRefresh >= self.refreshInterval:
+            self.get_phonebook(only_if_changed=True)
+
+    def _build_index(self, contacts):
+        index = {'name': {}, 'number': {}, 'uid': {}, 'contact_id': {}}
+        for contact in contacts:
+            if contact.contact_id is not None:
+                self._index_contact(contact, index)
+        return index
+
+    def _index_contact(self, contact, index=None):
+        if index is None:
+            index = self.index
+        if contact.contact_id is not None:
+            index['contact_id'].setdefault(contact.contact_id, contact)
+        if contact.name is not None:
+            index['name'].setdefault(contact.name, contact)
+        for number in contact.numbers:
+            index['number'].setdefault(_normalize_number(number), contact)
+        if contact.uid is not None:
+            index['uid'].setdefault(contact.uid, contact)
 
     def get_entry(self, name=None, number=None, uid=None, contact_id=None):
-        for contact in self.phonebookEntries.iter('contact'):
-            if name is not None:
-                for realName in contact.iter('realName'):
-                    if html.unescape(realName.text) == html.unescape(name):
-                        for idx in contact.iter('idx'):
-                            return {'contact_id': idx.text, 'contact': contact}
-            elif number is not None:
-                for realNumber in contact.iter('number'):
-                    if realNumber.text == number:
-                        for idx in contact.iter('idx'):
-                            return {'contact_id': idx.text, 'contact': contact}
-            elif uid is not None:
-                for uniqueid in contact.iter('uniqueid'):
-                    if uniqueid.text == uid:
-                        for idx in contact.iter('idx'):
-                            return {'contact_id': idx.text, 'contact': contact}
-            elif contact_id is not None:
-                phone_entry = fromstring(self.connection.call_action(
-                    'X_AVM-DE_OnTel', 'GetPhonebookEntry', NewPhonebookID=self.bookNumber,
-                    NewPhonebookEntryID=contact_id)['NewPhonebookEntryData'])
-                return {'contact_id': contact_id, 'contact': phone_entry}
+        if name is not None:
+            return self.index['name'].get(html.unescape(name))
+        elif number is not None:
+            return self.index['number'].get(_normalize_number(number))
+        elif uid is not None:
+            return self.index['uid'].get(uid)
+        elif contact_id is not None:
+            self.statistics['entry_fetches'] += 1
+            phone_entry = fromstring(self.connection.call_action(
+                'X_AVM-DE_OnTel', 'GetPhonebookEntry', NewPhonebookID=self.bookNumber,
+                NewPhonebookEntryID=contact_id)['NewPhonebookEntryData'])
+            return PhonebookContact.from_element(phone_entry, contact_id=contact_id)
+
+    def _get_current_entry(self, entry):
+        """
+        Fetch the contact from the box before it is written. The ids are the positions of the
+        contacts in the phonebook and can change when a contact is added, so the fetched contact
+        has to be the cached one. Otherwise the phonebook is downloaded again to find its id.
+        Returns the contact of the index and its element or None.
+        """
+        for download in (False, True):
+            if download:
+                self.get_phonebook()
+                uid, name = entry.uid, entry.name
+                entry = (self.get_entry(uid=uid) if uid else None) or self.get_entry(name=name)
+                if entry is None:
+                    return None
+            if entry.contact_id is None:
+                # added locally, the id is only known after the next download
+                continue
+            try:
+                phone_entry = self.get_entry(contact_id=entry.contact_id)
+            except Exception:
+                logger.warning('Id %s of %s not found', entry.contact_id, entry.name)
+                continue
+            if entry.uid and phone_entry.uid:
+                same = entry.uid == phone_entry.uid
+            else:
+                same = entry.name == phone_entry.name
+            if same:
+                entry.uid = entry.uid or phone_entry.uid
+                return entry, phone_entry.element
+        return None
 
     def add_entry_list(self, entry_list):
-        if entry_list:
-            for number, name in entry_list.items():
-                entry = self.get_entry(name=name)
-                if entry:
-                    if self.append_entry(entry, number):
-                        self.logger.info(
-                            '%s %s has been appended', name, number)
-                    else:
+        with self.lock:
+            self.batchDownloads = 0
+            self.refresh_phonebook()
+            if entry_list:
+                for number, name in entry_list.items():
+                    if self.get_entry(number=number):
                         self.logger.info('%s %s already defined', name, number)
-                else:
-                    if self.add_entry(number, name.replace('&', '&amp;')):
-                        self.logger.info('%s %s has been added', name, number)
-                        self.get_phonebook()
-
-    def append_entry(self, entry, phone_number):
-        phonebookEntry = self.get_entry(
-            contact_id=entry['contact_id'])['contact']
-        for realName in phonebookEntry.iter('realName'):
-            realName.text = realName.text
+                    else:
+                        self.queue_entry(number, name)
+                if self.pendingNumbers >= self.flushSize or self.flushInterval <= 0:
+                    self.flush()
+                elif self.flushTimer is None:
+                    self.flushTimer = threading.Timer(self.flushInterval, self.flush)
+                    self.flushTimer.daemon = True
+                    self.flushTimer.start()
+                self.logger.info(
+                    '%s full phonebook downloads for %s entries', self.batchDownloads, len(entry_list))
+
+    def queue_entry(self, phone_number, name):
+        """
+        Queue a number to be written to the phonebook. All numbers queued for
+        the same name are written with a single phonebook entry update.
+        """
+        with self.lock:
+            pending = self.pending.setdefault(name, {'numbers': [], 'retries': 0})
+            if phone_number not in pending['numbers']:
+                pending['numbers'].append(phone_number)
+                self.pendingNumbers += 1
+
+    def flush(self):
+        with self.lock:
+            if self.flushTimer is not None:
+                self.flushTimer.cancel()
+                self.flushTimer = None
+            pending, self.pending = self.pending, {}
+            self.pendingNumbers = 0
+            for name, item in pending.items():
+                try:
+                    self._write_entry(name, item['numbers'])
+                except Exception:
+                    item['retries'] += 1
+                    if item['retries'] < self.writeRetries:
+                        logger.warning('Writing %s %s failed, will be retried', name, item['numbers'])
+                        self.pending[name] = item
+                        self.pendingNumbers += len(item['numbers'])
+                    else:
+                        logger.error('Writing %s %s failed', name, item['numbers'], exc_info=True)
+            if self.pending and self.flushTimer is None:
+                self.flushTimer = threading.Timer(max(self.flushInterval, 10), self.flush)
+                self.flushTimer.daemon = True
+                self.flushTimer.start()
+
+    def _write_entry(self, name, numbers):
+        entry = self.get_entry(name=name)
+        if entry:
+            if self.append_entry(entry, numbers):
+                self.logger.info('%s %s has been appended', name, ', '.join(numbers))
+            else:
+                self.logger.info('%s %s already defined', name, ', '.join(numbers))
+        else:
+            if self.add_entry(numbers, name.replace('&', '&amp;')):
+                self.logger.info('%s %s has been added', name, ', '.join(numbers))
+
+    def append_entry(self, entry, phone_numbers):
+        if isinstance(phone_numbers, str):
+            phone_numbers = [phone_numbers]
+        current = self._get_current_entry(entry)
+        if current is None:
+            logger.error('Id of %s not found', ', '.join(phone_numbers))
+            return False
+        entry, phonebookEntry = current
         newnumber = None
         for number in phonebookEntry.iter('number'):
             if 'quickdial' in number.attrib:
                 del number.attrib['quickdial']
-            newnumber = copy.deepcopy(number)
+            newnumber = number
+        if newnumber is None:
+            return False
+        telephony = phonebookEntry.find('.//telephony')
+        existing = set(telephony.itertext())
+        new_numbers = [number for number in phone_numbers if number not in existing]
+        if not new_numbers:
+            return False
+        for phone_number in new_numbers:
+            newnumber = copy.deepcopy(newnumber)
             newnumber.text = phone_number
             newnumber.set('type', 'home')
             newnumber.set('prio', '1')
-        if not newnumber is None:
-            newnumberexists = False
-            for telephony in phonebookEntry.iter('telephony'):
-                for item in telephony.itertext():
-                    if item == phone_number:
-                        newnumberexists = True
-                        break
-            if not newnumberexists:
-                telephony.append(newnumber)
-                arg = {
-                    'NewPhonebookID': self.bookNumber,
-                    'NewPhonebookEntryID': entry['contact_id'],
-                    'NewPhonebookEntryData':
-                        '<?xml version="1.0" encoding="utf-8"?>' +
-                        '<Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope" ' +
-                        's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">' +
-                        tostring(phonebookEntry).decode("utf-8") +
-                        '</Envelope>'
-                }
-                self.connection.call_action(
-                    'X_AVM-DE_OnTel', 'SetPhonebookEntry', arguments=arg)
-                return True
-
-        return False
-
-    def add_entry(self, phone_number, name):
+            telephony.append(newnumber)
+        arg = {
+            'NewPhonebookID': self.bookNumber,
+            'NewPhonebookEntryID': entry.contact_id,
+            'NewPhonebookEntryData':
+                '<?xml version="1.0" encoding="utf-8"?>' +
+                '<Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope" ' +
+                's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">' +
+                tostring(phonebookEntry).decode("utf-8") +
+                '</Envelope>'
+        }
+        self.connection.call_action(
+            'X_AVM-DE_OnTel', 'SetPhonebookEntry', arguments=arg)
+        self.statistics['entry_writes'] += 1
+        entry.numbers += tuple(new_numbers)
+        for phone_number in new_numbers:
+            self.index['number'].setdefault(_normalize_number(phone_number), entry)
+        return True
+
+    def add_entry(self, phone_numbers, name):
+        if isinstance(phone_numbers, str):
+            phone_numbers = [phone_numbers]
+        contact = (
+            '<contact><category>0</category><person><realName>' +
+            name +
+            '</realName></person><telephony nid="{}">'.format(len(phone_numbers)) +
+            ''.join(
+                '<number type="home" prio="1" id="{}">{}</number>'.format(i, phone_number)
+                for i, phone_number in enumerate(phone_numbers)) +
+            '</telephony></contact>'
+        )
         arg = {
             'NewPhonebookID': self.bookNumber,
             'NewPhonebookEntryID': '',
@@ -158,15 +306,15 @@ class MyFritzPhonebook():
                 '<?xml version="1.0" encoding="utf-8"?>' +
                 '<Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope" ' +
                 's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">' +
-                '<contact><category>0</category><person><realName>' +
-                name +
-                '</realName></person><telephony nid="1"><number type="home" prio="1" id="0">' +
-                phone_number +
-                '</number></telephony></contact></Envelope>'
+                contact +
+                '</Envelope>'
         }
 
         self.connection.call_action(
             'X_AVM-DE_OnTel:1', 'SetPhonebookEntry', arguments=arg)
+        self.statistics['entry_writes'] += 1
+        # the id of the new contact is only looked up once it is needed
+        self._index_contact(PhonebookContact(name=html.unescape(name), numbers=phone_numbers))
         return True
 
 
@@ -174,3 +322,4 @@ if __name__ == '__main__':
     FPB = MyFritzPhonebook()
 #   to add an entry in the phonebook enter the number and here:
     FPB.add_entry_list({'123': 'AA & BB', '06731123': 'AA & BB'})
+    FPB.flush()
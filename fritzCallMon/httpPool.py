@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+import certifi
+import urllib3
+
+# import root directory into python module search path
+sys.path.insert(1, os.getcwd())  # noqa
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_http_pool(prefs=None):
+    """
+    Returns the process wide HttpPool. The pool is configured from the given
+    preferences when it is created by the first caller.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            prefs = prefs or {}
+            _pool = HttpPool(
+                num_pools=int(prefs.get('http_num_pools', 10)),
+                maxsize=int(prefs.get('http_pool_size', 4)),
+                connect_timeout=float(prefs.get('http_connect_timeout', 10)),
+                read_timeout=float(prefs.get('http_read_timeout', 30)),
+            )
+        return _pool
+
+
+class HttpPool():
+    """
+    Keep-alive connection pool per host shared by all outbound HTTP requests
+    """
+
+    def __init__(self, num_pools=10, maxsize=4, connect_timeout=10, read_timeout=30):
+        self.http = urllib3.PoolManager(
+            num_pools=num_pools,
+            maxsize=maxsize,
+            timeout=urllib3.Timeout(connect=connect_timeout, read=read_timeout),
+            cert_reqs='CERT_REQUIRED',
+            ca_certs=certifi.where(),
+        )
+        self.statistics = {}
+        self.lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        host = urlsplit(url if '://' in url else f'http://{url}').netloc
+        start = time.monotonic()
+        try:
+            response = self.http.request(method, url, **kwargs)
+        except Exception:
+            self._count(host, time.monotonic() - start, error=True)
+            raise
+        self._count(
+            host, time.monotonic() - start,
+            received=len(response.data) if kwargs.get('preload_content', True) else 0)
+        return response
+
+    def _count(self, host, elapsed, received=0, error=False):
+        with self.lock:
+            stats = self.statistics.setdefault(
+                host, {'requests': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0})
+            stats['requests'] += 1
+            stats['errors'] += int(error)
+            stats['bytes'] += received
+            stats['seconds'] += elapsed
+
+    def get_statistics(self):
+        with self.lock:
+            return {host: dict(stats) for host, stats in self.statistics.items()}
+
+
+if __name__ == '__main__':
+    HP = get_http_pool()
+    for i in range(3):
+        HP.request('GET', 'https://www.dasoertliche.de/')
+    print(HP.get_statistics())
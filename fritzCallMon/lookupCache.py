@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# import root directory into python module search path
+sys.path.insert(1, os.getcwd())  # noqa
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+
+_caches = {}
+_caches_lock = threading.Lock()
+_stem_cache = None
+
+
+def get_lookup_cache(prefs):
+    """
+    Returns the process wide LookupCache configured in the given preferences.
+    """
+    path = prefs.get('lookup_cache_file') or os.path.join(
+        os.path.dirname(prefs['name_not_found_file']), 'lookupCache.sqlite')
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = LookupCache(
+                path,
+                ttl_found=float(prefs.get('lookup_cache_ttl_found', 90)) * DAY,
+                ttl_not_found=float(prefs.get('lookup_cache_ttl_not_found', 30)) * DAY,
+                max_entries=int(prefs.get('lookup_cache_size', 10000)),
+            )
+            _caches[path] = cache
+        return cache
+
+
+def get_stem_cache(prefs):
+    """
+    Returns the process wide StemCache
+    """
+    global _stem_cache
+    with _caches_lock:
+        if _stem_cache is None:
+            _stem_cache = StemCache(max_entries=int(prefs.get('lookup_stem_cache_size', 10000)))
+        return _stem_cache
+
+
+class StemCache():
+    """
+    Names found during the fuzzy search for the switchboard of a number. The extensions
+    sharing a stem are resolved from it without any lookup. The cache is kept in memory,
+    after a restart the stems are found again in the LookupCache.
+    The least recently used stems are evicted once the cache exceeds max_entries.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.stems = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def find(self, candidates):
+        """
+        Returns (stem, name) of the first candidate being a known stem, (None, None) otherwise
+        """
+        with self.lock:
+            for candidate in candidates:
+                name = self.stems.get(candidate)
+                if name is not None:
+                    self.stems.move_to_end(candidate)
+                    self.hits += 1
+                    return candidate, name
+            self.misses += 1
+            return None, None
+
+    def set(self, stem, name):
+        with self.lock:
+            self.stems[stem] = name
+            self.stems.move_to_end(stem)
+            while len(self.stems) > self.max_entries:
+                self.stems.popitem(last=False)
+
+    def get_statistics(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.stems)}
+
+
+class LookupCache():
+    """
+    Persistent cache of reverse lookup results backed by SQLite.
+    Found names and numbers not found are kept with separate time to live.
+    The least recently used entries are evicted once the cache exceeds max_entries.
+    """
+
+    def __init__(self, path, ttl_found=90 * DAY, ttl_not_found=30 * DAY, max_entries=10000):
+        self.path = path
+        self.ttl_found = ttl_found
+        self.ttl_not_found = ttl_not_found
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS lookup ('
+            'number TEXT PRIMARY KEY, name TEXT, created REAL, accessed REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS lookup_accessed ON lookup (accessed)')
+        self.db.commit()
+        self.size = self.db.execute('SELECT COUNT(*) FROM lookup').fetchone()[0]
+
+    def get(self, number):
+        """
+        Returns the tuple (cached, name). name is None for cached numbers
+        which have not been found.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                'SELECT name, created FROM lookup WHERE number = ?', (number,)).fetchone()
+            if row is not None:
+                name, created = row
+                ttl = self.ttl_found if name is not None else self.ttl_not_found
+                if now - created <= ttl:
+                    self.db.execute('UPDATE lookup SET accessed = ? WHERE number = ?', (now, number))
+                    self.db.commit()
+                    self.hits += 1
+                    return True, name
+                self.db.execute('DELETE FROM lookup WHERE number = ?', (number,))
+                self.db.commit()
+                self.size -= 1
+            self.misses += 1
+            return False, None
+
+    def set(self, number, name):
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute(
+                'UPDATE lookup SET name = ?, created = ?, accessed = ? WHERE number = ?',
+                (name, now, now, number))
+            if not cursor.rowcount:
+                self.db.execute(
+                    'INSERT INTO lookup (number, name, created, accessed) VALUES (?, ?, ?, ?)',
+                    (number, name, now, now))
+                self.size += 1
+            if self.size > self.max_entries:
+                self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        evict = self.size - self.max_entries
+        self.db.execute(
+            'DELETE FROM lookup WHERE number IN '
+            '(SELECT number FROM lookup ORDER BY accessed LIMIT ?)', (evict,))
+        self.size -= evict
+        logger.debug('%s entries evicted from lookup cache', evict)
+
+    def get_statistics(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': self.size}
+
+
+if __name__ == '__main__':
+    LC = LookupCache(':memory:')
+    LC.set('0123456789', 'AA & BB')
+    LC.set('0987654321', None)
+    print(LC.get('0123456789'), LC.get('0987654321'), LC.get('0000'))
+    print(LC.get_statistics())
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import glob
+import importlib
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# import root directory into python module search path
+sys.path.insert(1, os.getcwd())  # noqa
+
+from dasOertliche import DasOertliche
+from fritzPhonebook import MyFritzPhonebook
+from lookupCache import get_lookup_cache
+from rateLimiter import get_rate_limiter
+from singleFlight import get_single_flight
+
+logger = logging.getLogger(__name__)
+
+"""
+Chain of reverse lookup providers
+
+ - The providers are asked in the order of LOOKUP_PROVIDERS until one of them knows the name:
+    - csv: the CSV files (number;name or number,name per row) in LOOKUP_CSV_DIR
+    - phonebooks: the phonebooks of the Fritzbox listed in LOOKUP_PHONEBOOKS
+    - dasoertliche: DasOertliche.de, using the lookup cache and the rate limit. Concurrent lookups
+      of the same number by any box or consumer are coalesced into one request.
+    - module.Class: a provider of your own, created with the preferences and the connection
+      to the Fritzbox, lookup(number) returns the name or None and raises on errors.
+ - With LOOKUP_HEDGE_AFTER seconds the next provider gets the query as well if the current one
+   has not answered in time, the first name found wins.
+ - The latency and the results are counted per provider, see LookupChain.get_statistics().
+"""
+
+
+def _normalize_number(number):
+    return ''.join(filter(str.isdigit, number))
+
+
+class CsvProvider():
+    """
+    Names of the CSV files in a directory, read again if a file has been changed
+    """
+    name = 'csv'
+
+    def __init__(self, prefs, connection=None):
+        self.directory = prefs.get('lookup_csv_dir', '')
+        self.names = {}
+        self.stat = None
+        self.lock = threading.Lock()
+
+    def _get_stat(self):
+        files = sorted(glob.glob(os.path.join(self.directory, '*.csv')))
+        return [(file, os.stat(file).st_mtime_ns) for file in files]
+
+    def _load(self, stat):
+        names = {}
+        for file, mtime in stat:
+            with open(file, encoding='utf-8', mode='r', newline='') as csvfile:
+                try:
+                    dialect = csv.Sniffer().sniff(csvfile.read(4096), delimiters=';,\t')
+                except csv.Error:
+                    dialect = 'excel'
+                csvfile.seek(0)
+                for row in csv.reader(csvfile, dialect):
+                    if len(row) >= 2 and _normalize_number(row[0]):
+                        names.setdefault(_normalize_number(row[0]), row[1].strip())
+        self.names = names
+        self.stat = stat
+        logger.info('%s names read from %s', len(names), self.directory)
+
+    def lookup(self, number):
+        with self.lock:
+            stat = self._get_stat()
+            if stat != self.stat:
+                self._load(stat)
+        return self.names.get(_normalize_number(number))
+
+
+class PhonebooksProvider():
+    """
+    Names of the phonebooks of the Fritzbox
+    """
+    name = 'phonebooks'
+
+    def __init__(self, prefs, connection=None):
+        self.phonebooks = [
+            MyFritzPhonebook(connection=connection, name=name.strip(), prefs=prefs)
+            for name in prefs.get('lookup_phonebooks', '').split(',') if name.strip()]
+
+    def lookup(self, number):
+        for phonebook in self.phonebooks:
+            with phonebook.lock:
+                phonebook.refresh_phonebook()
+                contact = phonebook.get_entry(number=number)
+            if contact:
+                return contact.name
+        return None
+
+
+class DasOertlicheProvider():
+    name = 'dasoertliche'
+
+    def __init__(self, prefs, connection=None):
+        self.cache = get_lookup_cache(prefs)
+        self.rateLimiter = get_rate_limiter(
+            'dasoertliche',
+            rate=float(prefs.get('lookup_rate', 2)),
+            burst=int(prefs.get('lookup_burst', 2)))
+        self.singleFlight = get_single_flight('dasoertliche')
+
+    def lookup(self, number):
+        return self.singleFlight.do(_normalize_number(number), self._lookup, number)
+
+    def _lookup(self, number):
+        result = DasOertliche(lookup_number=number, cache=self.cache, rate_limiter=self.rateLimiter)
+        if result.failed:
+            raise LookupError(f'DasOertliche lookup of {number} failed')
+        return result.name
+
+
+PROVIDERS = {
+    CsvProvider.name: CsvProvider,
+    PhonebooksProvider.name: PhonebooksProvider,
+    DasOertlicheProvider.name: DasOertlicheProvider,
+}
+
+
+def get_provider(name, prefs, connection=None):
+    if name in PROVIDERS:
+        return PROVIDERS[name](prefs, connection)
+    module, _, cls = name.rpartition('.')
+    if not module:
+        raise ValueError(f'Unknown lookup provider {name}, use one of {", ".join(PROVIDERS)} or module.Class')
+    provider = getattr(importlib.import_module(module), cls)(prefs, connection)
+    if not hasattr(provider, 'name'):
+        provider.name = name
+    return provider
+
+
+class LookupChain():
+
+    def __init__(self, providers, hedge_after=0, workers=4):
+        self.providers = providers
+        self.hedgeAfter = hedge_after
+        # the hedged queries run in threads of their own, the callers are lookup threads already
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers * 2, thread_name_prefix='provider') if hedge_after > 0 else None
+        self.statistics = {
+            provider.name: {'queries': 0, 'found': 0, 'not_found': 0, 'errors': 0,
+                            'hedged': 0, 'wins': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+            for provider in providers}
+        self.lock = threading.Lock()
+
+    def _query(self, provider, number):
+        start = time.monotonic()
+        name, error = None, False
+        try:
+            name = provider.lookup(number)
+        except Exception:
+            error = True
+            logger.error('Lookup of %s by %s failed', number, provider.name, exc_info=True)
+        elapsed = time.monotonic() - start
+        with self.lock:
+            stats = self.statistics[provider.name]
+            stats['queries'] += 1
+            stats['errors' if error else 'found' if name else 'not_found'] += 1
+            stats['seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+        return name, error
+
+    def _won(self, provider):
+        with self.lock:
+            self.statistics[provider.name]['wins'] += 1
+
+    def lookup(self, number):
+        """
+        Returns the name and whether a provider failed, so a missing name may only be temporary
+        """
+        if self.executor is None:
+            failed = False
+            for provider in self.providers:
+                name, error = self._query(provider, number)
+                if name:
+                    self._won(provider)
+                    return name, False
+                failed |= error
+            return None, failed
+        return self._hedged_lookup(number)
+
+    def _hedged_lookup(self, number):
+        providers = iter(self.providers)
+        pending = {}
+        failed = False
+
+        def start_next(hedged=False):
+            provider = next(providers, None)
+            if provider is not None:
+                pending[self.executor.submit(self._query, provider, number)] = provider
+                if hedged:
+                    with self.lock:
+                        self.statistics[provider.name]['hedged'] += 1
+            return provider
+
+        start_next()
+        while pending:
+            done, _ = wait(pending, timeout=self.hedgeAfter, return_when=FIRST_COMPLETED)
+            if not done:
+                # the current providers are slow, ask the next one as well
+                start_next(hedged=True)
+                continue
+            for future in done:
+                provider = pending.pop(future)
+                name, error = future.result()
+                if name:
+                    self._won(provider)
+                    for other in pending:
+                        other.cancel()
+                    return name, False
+                failed |= error
+            if not pending:
+                start_next()
+        return None, failed
+
+    def get_statistics(self):
+        with self.lock:
+            return {name: dict(stats) for name, stats in self.statistics.items()}
+
+
+def get_lookup_chain(prefs, connection=None):
+    """
+    Returns a LookupChain of the providers configured in the given preferences
+    """
+    return LookupChain(
+        [get_provider(name.strip(), prefs, connection)
+         for name in prefs.get('lookup_providers', 'dasoertliche').split(',') if name.strip()],
+        hedge_after=float(prefs.get('lookup_hedge_after', 0)),
+        workers=int(prefs.get('lookup_workers', 4)))
+
+
+if __name__ == '__main__':
+    import random
+
+    class SlowProvider():
+
+        def __init__(self, name, delay, names):
+            self.name = name
+            self.delay = delay
+            self.names = names
+
+        def lookup(self, number):
+            time.sleep(random.expovariate(1 / self.delay))
+            return self.names.get(number)
+
+    names = {str(n): f'Name {n}' for n in range(100)}
+    for hedge_after in (0, 0.05):
+        chain = LookupChain([SlowProvider('slow', 0.1, names), SlowProvider('fast', 0.02, names)],
+                            hedge_after=hedge_after)
+        start = time.monotonic()
+        for number in names:
+            chain.lookup(number)
+        print(f'hedge after {hedge_after}s: {time.monotonic() - start:.2f}s', chain.get_statistics())
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+
+
+class NamesNotFound():
+    """
+    Set of numbers not found during the backward search.
+    The numbers are kept in memory as hash set and are appended to the file
+    as journal of "number<TAB>timestamp" lines. The file is compacted once the
+    journal holds more than twice the live entries. Numbers expire after ttl
+    seconds, a ttl of 0 keeps them forever. Lines without timestamp (the former
+    format of the file) get the modification time of the file.
+    The file is only read again if it has been changed by someone else.
+    """
+
+    def __init__(self, path, ttl=0):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        self.journalLength = 0
+        self.stat = None
+        self.statistics = {'loads': 0, 'appends': 0, 'compactions': 0}
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        entries = {}
+        length = 0
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, encoding='utf-8', mode='r') as file:
+                for line in file:
+                    fields = line.strip().split('\t')
+                    if not fields[0]:
+                        continue
+                    length += 1
+                    try:
+                        timestamp = float(fields[1]) if len(fields) > 1 else mtime
+                    except ValueError:
+                        timestamp = mtime
+                    entries[fields[0]] = max(timestamp, entries.get(fields[0], 0))
+        except FileNotFoundError:
+            with open(self.path, encoding='utf-8', mode='w+'):
+                pass
+        self.entries = entries
+        self.journalLength = length
+        self.statistics['loads'] += 1
+        self.stat = self._get_stat()
+
+    def _get_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload_if_changed(self):
+        """
+        Reads the file again if it has been changed since it was read or written by us
+        """
+        with self.lock:
+            if self._get_stat() != self.stat:
+                logger.info('%s has been changed, reloading', self.path)
+                self._load()
+                return True
+        return False
+
+    def _expired(self, timestamp, now):
+        return self.ttl > 0 and now - timestamp > self.ttl
+
+    def __contains__(self, number):
+        timestamp = self.entries.get(number)
+        return timestamp is not None and not self._expired(timestamp, time.time())
+
+    def __iter__(self):
+        now = time.time()
+        return iter([number for number, timestamp in self.entries.items() if not self._expired(timestamp, now)])
+
+    def __len__(self):
+        return sum(1 for number in self)
+
+    def add(self, number):
+        self.update((number, ))
+
+    def update(self, numbers):
+        now = time.time()
+        lines = []
+        with self.lock:
+            for number in numbers:
+                if number and number not in self:
+                    self.entries[number] = now
+                    lines.append(f'{number}\t{now:.0f}\n')
+            if lines:
+                with open(self.path, encoding='utf-8', mode='a') as file:
+                    file.writelines(lines)
+                self.journalLength += len(lines)
+                self.statistics['appends'] += 1
+                self.stat = self._get_stat()
+            if self.journalLength > 2 * len(self.entries) + 1000:
+                self._compact(now)
+
+    def compact(self):
+        with self.lock:
+            self._compact(time.time())
+
+    def _compact(self, now):
+        self.entries = {
+            number: timestamp for number, timestamp in self.entries.items()
+            if not self._expired(timestamp, now)}
+        tmp = self.path + '.tmp'
+        with open(tmp, encoding='utf-8', mode='w') as file:
+            file.writelines(f'{number}\t{timestamp:.0f}\n' for number, timestamp in self.entries.items())
+        os.replace(tmp, self.path)
+        self.journalLength = len(self.entries)
+        self.statistics['compactions'] += 1
+        self.stat = self._get_stat()
+        logger.debug('%s has been compacted to %s entries', self.path, self.journalLength)
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), 'nameNotFound.list')
+    NNF = NamesNotFound(path, ttl=30 * DAY)
+    NNF.update(['0123456', '0654321', '0123456'])
+    print('0123456' in NNF, '0999' in NNF, len(NNF))
+    print(open(path).read())
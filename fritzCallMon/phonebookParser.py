@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import html
+import re
+from xml.etree.ElementTree import XMLPullParser
+
+IDX_COMMENT = re.compile(r'\s*idx:(\d+)\s*')
+
+
+class PhonebookContact():
+    """
+    Compact record of a phonebook contact. The element of the contact is
+    only kept once it has been fetched from the Fritz!Box for an update.
+    """
+    __slots__ = ('contact_id', 'name', 'numbers', 'uid', 'element')
+
+    def __init__(self, contact_id=None, name=None, numbers=(), uid=None, element=None):
+        self.contact_id = contact_id
+        self.name = name
+        self.numbers = tuple(numbers)
+        self.uid = uid
+        self.element = element
+
+    @classmethod
+    def from_element(cls, element, contact_id=None):
+        name = None
+        for realName in element.iter('realName'):
+            if realName.text is not None:
+                name = html.unescape(realName.text)
+                break
+        uid = None
+        for uniqueid in element.iter('uniqueid'):
+            uid = uniqueid.text
+        return cls(
+            contact_id=contact_id,
+            name=name,
+            numbers=[number.text for number in element.iter('number') if number.text],
+            uid=uid,
+            element=element,
+        )
+
+    def __repr__(self):
+        return 'PhonebookContact({!r}, {!r}, {!r}, {!r})'.format(
+            self.contact_id, self.name, self.numbers, self.uid)
+
+
+class PhonebookParser():
+    """
+    Incremental parser of the Fritz!Box phonebook export. The contacts are
+    returned as PhonebookContact records as soon as they are complete and
+    are dropped from the parsed tree, so the whole document is never held.
+    The <!-- idx:N --> comments of the export hold the id of each contact.
+    """
+
+    def __init__(self):
+        self.timestamp = None
+        self._parser = XMLPullParser(events=('end', 'comment'))
+        self._contact = None
+
+    def feed(self, data):
+        self._parser.feed(data)
+        return self._read_events()
+
+    def close(self):
+        self._parser.close()
+        return self._read_events()
+
+    def _read_events(self):
+        contacts = []
+        contact = self._contact
+        for event, element in self._parser.read_events():
+            tag = element.tag
+            if tag == 'contact':
+                contacts.append(PhonebookContact(*contact) if contact else PhonebookContact())
+                contact = None
+                element.clear()
+            elif tag == 'realName' or tag == 'number' or tag == 'uniqueid' or event == 'comment':
+                if contact is None:
+                    # contact_id, name, numbers, uid
+                    contact = [None, None, [], None]
+                text = element.text
+                if event == 'comment':
+                    m = IDX_COMMENT.fullmatch(text or '')
+                    if m:
+                        contact[0] = m.group(1)
+                elif tag == 'number':
+                    if text:
+                        contact[2].append(text)
+                elif tag == 'realName':
+                    if contact[1] is None and text is not None:
+                        contact[1] = html.unescape(text)
+                else:
+                    contact[3] = text
+            elif tag == 'timestamp':
+                self.timestamp = element.text
+        self._contact = contact
+        return contacts
+
+
+def parse_phonebook(chunks, parser=None):
+    """
+    Yields the contacts of the phonebook export given as iterable of byte chunks
+    """
+    parser = parser or PhonebookParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+
+def _synthetic_phonebook(contacts, chunk_size=65536):
+    chunk = [b'<?xml version="1.0" encoding="utf-8"?><phonebooks><phonebook owner="1" name="Collected_Calls">'
+             b'<timestamp>1700000000</timestamp>']
+    size = 0
+    for i in range(contacts):
+        contact = (
+            '<contact><category>0</category><person><realName>Caller {0} &amp;amp; Sons</realName></person>'
+            '<telephony nid="2"><number type="home" prio="1" id="0">0621{0:07d}</number>'
+            '<number type="work" prio="0" id="1">0621{0:07d}0</number></telephony>'
+            '<services /><setup /><features doorphone="0" /><mod_time>1700000000</mod_time>'
+            '<uniqueid>{0}</uniqueid><!-- idx:{0} --></contact>'
+        ).format(i).encode('utf-8')
+        chunk.append(contact)
+        size += len(contact)
+        if size >= chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(b'</phonebook></phonebooks>')
+    yield b''.join(chunk)
+
+
+if __name__ == '__main__':
+    # benchmark of the streaming parser against parsing the whole document
+    import time
+    import tracemalloc
+    from xml.etree.ElementTree import fromstring
+
+    def parse_document(chunks):
+        data = b''.join(chunks)
+        root = fromstring(
+            re.sub(r"!-- idx:(\d+) --", lambda m: "idx>"+m.group(1)+"</idx", data.decode("utf-8")))
+        return [contact for contact in root.iter('contact')]
+
+    def parse_streaming(chunks):
+        return list(parse_phonebook(chunks))
+
+    for contacts in (1000, 10000, 100000):
+        for name, parse in (('document', parse_document), ('streaming', parse_streaming)):
+            start = time.perf_counter()
+            result = parse(_synthetic_phonebook(contacts))
+            elapsed = time.perf_counter() - start
+            del result
+            # measure the memory in a second run, tracing slows down the parser
+            tracemalloc.start()
+            result = parse(_synthetic_phonebook(contacts))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'{contacts:7d} contacts {name:10s} {elapsed * 1000:10.1f} ms '
+                  f'peak {peak / 1024 / 1024:8.1f} MiB ({len(result)} contacts)')
+            del result
@@ -4,8 +4,7 @@ import sys
 import logging
 
 
-# read configuration from the configuration file and prepare a preferences dict
-def read_configuration():
+def _read_file():
     logger = logging.getLogger()
 
     filename = os.path.join(
@@ -16,15 +15,29 @@ def read_configuration():
     if os.path.isfile(filename):
         cfg = configparser.ConfigParser()
         cfg.read(filename)
-        preferences = {}
-        for name, value in cfg.items('DEFAULT'):
-            if name == 'status_to_terminal':
-                preferences[name] = cfg.getboolean(
-                    'DEFAULT', 'status_to_terminal')
-            else:
-                preferences[name] = value
-        return preferences
+        return cfg
     logger.error('%s not found', filename)
     sys.exit(1)
 
 
+# read configuration from the configuration file and prepare a preferences dict
+# the settings of a box are read from its [box:name] section, missing ones from the DEFAULT section
+def read_configuration(box=None):
+    cfg = _read_file()
+    section = f'box:{box}' if box else 'DEFAULT'
+    preferences = {}
+    for name, value in cfg.items(section):
+        if name in ('status_to_terminal', 'audio_preprocess'):
+            preferences[name] = cfg.getboolean(section, name)
+        else:
+            preferences[name] = value
+    if box:
+        preferences['box'] = box
+    return preferences
+
+
+# names of the boxes configured in [box:name] sections
+def get_box_names():
+    return [section[4:] for section in _read_file().sections() if section.startswith('box:')]
+
+
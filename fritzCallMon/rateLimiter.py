@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name, rate=2.0, burst=1):
+    """
+    Returns the process wide RateLimiter of the named lookup provider, so all boxes
+    monitored by the process stay within the same limit.
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            limiter = _limiters[name] = RateLimiter(rate=rate, burst=burst)
+        return limiter
+
+
+class RateLimiter():
+    """
+    Token bucket limiting the requests per second sent to a lookup provider.
+    A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate=2.0, burst=1):
+        self.rate = float(rate)
+        self.burst = max(int(burst), 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+if __name__ == '__main__':
+    RL = RateLimiter(rate=5, burst=2)
+    start = time.monotonic()
+    for i in range(10):
+        RL.acquire()
+        print(f'{i} {time.monotonic() - start:.2f}s')
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from concurrent.futures import Future
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def get_single_flight(name):
+    """
+    Returns the process wide SingleFlight of the named lookup provider, so the
+    lookups of all consumers and boxes are coalesced.
+    """
+    with _flights_lock:
+        flight = _flights.get(name)
+        if flight is None:
+            flight = _flights[name] = SingleFlight()
+        return flight
+
+
+def get_single_flight_statistics():
+    with _flights_lock:
+        return {name: dict(flight.statistics) for name, flight in _flights.items()}
+
+
+class SingleFlight():
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the function,
+    the callers arriving while it is running wait for its result (or exception).
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.statistics = {'calls': 0, 'coalesced': 0}
+        self.lock = threading.Lock()
+
+    def do(self, key, function, *args, **kwargs):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+                self.statistics['calls'] += 1
+            else:
+                self.statistics['coalesced'] += 1
+        if leader:
+            try:
+                future.set_result(function(*args, **kwargs))
+            except BaseException as e:
+                # the waiting callers get the exception as well, e.g. a SystemExit of a provider
+                future.set_exception(e)
+                raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+        return future.result()
+
+
+if __name__ == '__main__':
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    def slow_lookup(number):
+        time.sleep(0.1)
+        return f'Name of {number}'
+
+    SF = SingleFlight()
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        start = time.monotonic()
+        results = list(executor.map(lambda n: SF.do(n % 3, slow_lookup, n % 3), range(60)))
+    print(f'{len(results)} lookups in {time.monotonic() - start:.2f}s', SF.statistics)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+import importlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+"""
+Transcription of the phone messages in a pool of worker threads
+
+ - Transcriber.submit() queues the WAV file and returns at once, the callback gets the text
+   (or the exception) when the transcription has finished.
+ - With an AudioPreprocessor the silence is trimmed and long messages are split into chunks,
+   which are transcribed in parallel and joined again. The bytes sent and the time until the
+   transcript is ready are logged per message.
+ - The recognizer is pluggable: google (online, default), sphinx (offline), none (returns
+   an empty text) or the dotted path of a class like mymodule.MyRecognizer, which is
+   created with the language and has to provide recognize(filename).
+"""
+
+
+class GoogleRecognizer():
+
+    def __init__(self, language='de-DE'):
+        import speech_recognition as sr
+        self.sr = sr
+        self.language = language
+
+    def _record(self, filename):
+        r = self.sr.Recognizer()
+        with self.sr.AudioFile(filename) as source:
+            # listen for the data (load audio to memory)
+            return r, r.record(source)
+
+    def recognize(self, filename):
+        r, audio_data = self._record(filename)
+        return r.recognize_google(audio_data, language=self.language)
+
+
+class SphinxRecognizer(GoogleRecognizer):
+
+    def recognize(self, filename):
+        r, audio_data = self._record(filename)
+        return r.recognize_sphinx(audio_data, language=self.language)
+
+
+class NullRecognizer():
+
+    def __init__(self, language=None):
+        pass
+
+    def recognize(self, filename):
+        return ''
+
+
+RECOGNIZERS = {
+    'google': GoogleRecognizer,
+    'sphinx': SphinxRecognizer,
+    'none': NullRecognizer,
+}
+
+
+def get_recognizer(name='google', language='de-DE'):
+    if name in RECOGNIZERS:
+        return RECOGNIZERS[name](language)
+    module, _, cls = name.rpartition('.')
+    if not module:
+        raise ValueError(f'Unknown speech recognizer {name}, use one of {", ".join(RECOGNIZERS)} or module.Class')
+    return getattr(importlib.import_module(module), cls)(language)
+
+
+class _Job():
+    __slots__ = ('filename', 'chunks', 'stats', 'callback', 'start', 'texts', 'errors', 'remaining')
+
+    def __init__(self, filename, chunks, stats, callback, start):
+        self.filename = filename
+        self.chunks = chunks
+        self.stats = stats
+        self.callback = callback
+        self.start = start
+        self.texts = [None] * len(chunks)
+        self.errors = [None] * len(chunks)
+        self.remaining = len(chunks)
+
+
+class Transcriber():
+
+    def __init__(self, recognizer, workers=2, retries=5, preprocessor=None):
+        self.recognizer = recognizer
+        self.retries = retries
+        self.preprocessor = preprocessor
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='transcribe')
+        self.statistics = {'jobs': 0, 'transcribed': 0, 'failed': 0, 'seconds': 0.0,
+                           'bytes_in': 0, 'bytes_sent': 0}
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.pending = 0
+
+    def submit(self, filename, callback):
+        """
+        Queues the file for transcription, callback(text, error) is called in a worker thread
+        """
+        with self.lock:
+            self.statistics['jobs'] += 1
+            self.pending += 1
+        self.executor.submit(self._prepare, filename, callback, time.monotonic())
+
+    def _prepare(self, filename, callback, start):
+        try:
+            size = os.path.getsize(filename)
+        except OSError as e:
+            self._finish(_Job(filename, [], {'bytes_in': 0, 'bytes_out': 0}, callback, start), e)
+            return
+        chunks = [filename]
+        stats = {'bytes_in': size, 'bytes_out': size}
+        if self.preprocessor is not None:
+            try:
+                chunks, stats = self.preprocessor.process(filename)
+            except Exception as e:
+                logger.error('Error preprocessing %s, using it unchanged: %s', filename, e)
+        job = _Job(filename, chunks, stats, callback, start)
+        if not chunks:
+            # nothing but silence
+            self._finish(job)
+            return
+        # every chunk is a job of its own, so no worker waits for another one
+        for n in range(len(chunks)):
+            self.executor.submit(self._recognize, job, n)
+
+    def _recognize(self, job, n):
+        filename = job.chunks[n]
+        text, error = None, None
+        for attempt in range(self.retries):
+            try:
+                text = self.recognizer.recognize(filename)
+                error = None
+                break
+            except Exception as e:
+                error = e
+                logger.error('Error in speech_to_text %s', e)
+        if filename != job.filename:
+            os.remove(filename)
+        with self.lock:
+            job.texts[n] = text
+            job.errors[n] = error
+            job.remaining -= 1
+            if job.remaining:
+                return
+        self._finish(job)
+
+    def _finish(self, job, error=None):
+        errors = [error for error in job.errors if error is not None]
+        if errors and len(errors) == len(job.chunks):
+            # a failed chunk only fails the message if no chunk has been transcribed
+            error = errors[0]
+        text = None if error else ' '.join(text for text in job.texts if text)
+        elapsed = time.monotonic() - job.start
+        with self.lock:
+            self.statistics['transcribed' if error is None else 'failed'] += 1
+            self.statistics['seconds'] += elapsed
+            self.statistics['bytes_in'] += job.stats['bytes_in']
+            self.statistics['bytes_sent'] += job.stats['bytes_out']
+        logger.info('%s transcribed in %.1fs, %s of %s bytes sent in %s chunks',
+                    job.filename, elapsed, job.stats['bytes_out'], job.stats['bytes_in'], len(job.chunks))
+        try:
+            job.callback(text, error)
+        except Exception:
+            logger.error('Error in transcription callback', exc_info=True)
+        finally:
+            with self.lock:
+                self.pending -= 1
+                self.idle.notify_all()
+
+    def shutdown(self, wait=True):
+        if wait:
+            with self.lock:
+                self.idle.wait_for(lambda: not self.pending)
+        self.executor.shutdown(wait=wait)
+
+
+if __name__ == '__main__':
+    import sys
+
+    from audioPreprocessor import AudioPreprocessor
+
+    if len(sys.argv) < 2:
+        print(f'usage: {sys.argv[0]} file.wav [recognizer]')
+        sys.exit(1)
+    transcriber = Transcriber(get_recognizer(*sys.argv[2:3]), retries=1, preprocessor=AudioPreprocessor())
+    transcriber.submit(sys.argv[1], lambda text, error: print(text if error is None else error))
+    transcriber.shutdown()
+    print(transcriber.statistics)
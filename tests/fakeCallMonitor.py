@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+# import the package directory into python module search path
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fritzCallMon'))  # noqa
+
+from callMonitorReader import open_call_monitor, read_lines
+
+"""
+Fake Fritzbox call monitor for replaying recorded call monitor lines
+
+ - Serves the lines of a replay file (one call monitor line per row) or a burst
+   of synthetic RING/CONNECT/DISCONNECT lines on a local port.
+ - The lines are sent in random chunks, so lines are split across chunk boundaries
+   and several lines arrive coalesced in one chunk, like the Fritzbox does under load.
+ - With --check the call monitor reader connects to the fake server and verifies
+   that every line is received exactly once.
+
+   python tests/fakeCallMonitor.py --events 10000 --check
+   python tests/fakeCallMonitor.py --replay calls.txt --port 1012
+"""
+
+
+def synthetic_lines(events):
+    lines = []
+    for call_id in range(events // 3):
+        date = time.strftime('%d.%m.%y %H:%M:%S')
+        caller = '0621{:07d}'.format(random.randint(0, 9999999))
+        lines.append(f'{date};RING;{call_id % 10};{caller};555;SIP0;'.encode())
+        lines.append(f'{date};CONNECT;{call_id % 10};40;{caller};'.encode())
+        lines.append(f'{date};DISCONNECT;{call_id % 10};12;'.encode())
+    return lines
+
+
+def read_replay(filename):
+    with open(filename, mode='rb') as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+class FakeCallMonitor():
+
+    def __init__(self, lines, max_chunk=256, rate=0):
+        self.lines = lines
+        self.max_chunk = max_chunk
+        self.rate = rate
+
+    async def handle(self, reader, writer):
+        data = b''.join(line + b'\r\n' for line in self.lines)
+        pos = 0
+        sent = 0
+        start = time.monotonic()
+        while pos < len(data):
+            size = random.randint(1, self.max_chunk)
+            chunk = data[pos:pos + size]
+            writer.write(chunk)
+            await writer.drain()
+            pos += size
+            if self.rate:
+                # throttle to the given lines per second
+                sent += chunk.count(b'\n')
+                delay = sent / self.rate - (time.monotonic() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        writer.close()
+
+    async def serve(self, host='127.0.0.1', port=0):
+        return await asyncio.start_server(self.handle, host, port)
+
+
+async def check(lines, max_chunk, rate):
+    fake = FakeCallMonitor(lines, max_chunk=max_chunk, rate=rate)
+    server = await fake.serve()
+    host, port = server.sockets[0].getsockname()[:2]
+    reader, writer = await open_call_monitor(host, port)
+    start = time.monotonic()
+    received = [line async for line in read_lines(reader)]
+    elapsed = time.monotonic() - start
+    writer.close()
+    server.close()
+    print(f'{len(received)} of {len(lines)} lines received in {elapsed:.3f}s '
+          f'({len(received) / elapsed:.0f} lines/s)')
+    if received != lines:
+        print('ERROR: received lines differ from the sent lines')
+        return 1
+    return 0
+
+
+async def serve(lines, port, max_chunk, rate):
+    server = await FakeCallMonitor(lines, max_chunk=max_chunk, rate=rate).serve('', port)
+    print(f'Fake call monitor listening on port {port}')
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Fritzbox call monitor')
+    parser.add_argument('-r', '--replay',
+                        help='File with call monitor lines to be replayed.')
+    parser.add_argument('-e', '--events', type=int, default=300,
+                        help='Number of synthetic events if no replay file is given. Default: 300')
+    parser.add_argument('-p', '--port', type=int, default=1012,
+                        help='Port the fake call monitor listens on. Default: 1012')
+    parser.add_argument('--chunk', type=int, default=256,
+                        help='Maximum size of the chunks the lines are sent in. Default: 256')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Lines per second, 0 sends them as fast as possible. Default: 0')
+    parser.add_argument('--check', action='store_true',
+                        help='Receive the lines with the call monitor reader and verify them.')
+    cli = parser.parse_args()
+
+    lines = read_replay(cli.replay) if cli.replay else synthetic_lines(cli.events)
+    if cli.check:
+        sys.exit(asyncio.run(check(lines, cli.chunk, cli.rate)))
+    asyncio.run(serve(lines, cli.port, cli.chunk, cli.rate))
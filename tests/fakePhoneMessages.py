@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+# import the package directory into python module search path
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fritzCallMon'))  # noqa
+
+"""
+Fake Fritzbox serving phone messages for testing the streaming download
+
+ - Answers /lua/photo.lua?sid=...&myabfile=path with a synthetic message of --size bytes,
+   sent in small chunks.
+ - A path ending in .truncated announces more bytes than are sent, a path ending in
+   .missing is answered with 404.
+ - With --check the download of FritzCallsDuringAbsense is verified against the fake box:
+   a complete download, a truncated download leaving no .part file, an HTTP error and
+   skipping a phone message which has been downloaded after the call.
+
+   python tests/fakePhoneMessages.py --check
+   python tests/fakePhoneMessages.py --port 8080
+"""
+
+
+def synthetic_message(size):
+    return bytes(range(256)) * (size // 256) + bytes(range(size % 256))
+
+
+class FakePhoneMessages(ThreadingHTTPServer):
+
+    def __init__(self, address, size=200000, chunk=4096):
+        super().__init__(address, PhoneMessageHandler)
+        self.message = synthetic_message(size)
+        self.chunk = chunk
+        self.requests = 0
+
+
+class PhoneMessageHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests += 1
+        url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.parse_qs(url.query).get('myabfile', [''])[0]
+        if url.path != '/lua/photo.lua' or path.endswith('.missing'):
+            self.send_error(404)
+            return
+        message = self.server.message
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/x-wav')
+        if path.endswith('.truncated'):
+            self.send_header('Content-Length', str(len(message)))
+            message = message[:len(message) // 2]
+            self.close_connection = True
+        else:
+            self.send_header('Content-Length', str(len(message)))
+        self.end_headers()
+        for pos in range(0, len(message), self.server.chunk):
+            self.wfile.write(message[pos:pos + self.server.chunk])
+            self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeConnection():
+
+    def __init__(self, address):
+        self.address = address
+
+    def call_action(self, service, action, **kwargs):
+        if action == 'GetVoIPCommonAreaCode':
+            return {'NewVoIPAreaCode': '0621'}
+        if action == 'GetCallList':
+            return {'NewCallListURL': f'http://{self.address}/calllist.lua?sid=0123456789abcdef'}
+        raise NotImplementedError(action)
+
+
+def check(size):
+    from fritzCallsDuringAbsense import FritzCallsDuringAbsense
+
+    server = FakePhoneMessages(('127.0.0.1', 0), size=size)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    address = '{}:{}'.format(*server.server_address)
+    directory = tempfile.mkdtemp()
+    errors = 0
+
+    def verify(name, condition):
+        nonlocal errors
+        print(f'{"ok" if condition else "ERROR":5s} {name}')
+        errors += not condition
+
+    try:
+        FCDA = FritzCallsDuringAbsense(FakeConnection(address), prefs={
+            'fritz_ip_address': address, 'phone_msg_dir': directory, 'speech_recognizer': 'none',
+            'pushover_token': '', 'pushover_userkey': ''})
+        now = time.strftime('%d.%m.%y %H:%M')
+
+        def call(path, date=now):
+            return SimpleNamespace(Path=f'/download.lua?path=/data/tam/rec/{path}', Date=date)
+
+        def part_files():
+            return [file for file in os.listdir(FCDA.phoneMsgDir) if file.endswith('.part')]
+
+        start = time.monotonic()
+        filename = FCDA.get_phone_message(call('rec.0.000'))
+        elapsed = time.monotonic() - start
+        with open(filename, 'rb') as wave:
+            verify(f'complete download, {size} bytes in {elapsed:.3f}s', wave.read() == server.message)
+
+        filename = FCDA.get_phone_message(call('rec.0.001.truncated'))
+        verify('truncated download is discarded', filename == '' and not os.path.exists(
+            os.path.join(FCDA.phoneMsgDir, 'rec.0.001.truncated.wav')))
+        verify('truncated download leaves no .part file', not part_files())
+
+        filename = FCDA.get_phone_message(call('rec.0.002.missing'))
+        verify('HTTP error is reported', filename == '' and not os.path.exists(
+            os.path.join(FCDA.phoneMsgDir, 'rec.0.002.missing.wav')))
+        verify('HTTP error leaves no .part file', not part_files())
+
+        requests = server.requests
+        filename = FCDA.get_phone_message(call('rec.0.000', date='01.01.20 00:00'))
+        verify('message newer than the call is not downloaded again',
+               filename.endswith('rec.0.000.wav') and server.requests == requests)
+        os.utime(filename, (0, 0))
+        FCDA.get_phone_message(call('rec.0.000'))
+        verify('message older than the call is downloaded again', server.requests == requests + 1)
+        FCDA.transcriber.shutdown()
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+    return 1 if errors else 0
+
+
+def serve(port, size):
+    server = FakePhoneMessages(('', port), size=size)
+    print(f'Fake phone messages listening on port {port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Fritzbox phone message download')
+    parser.add_argument('-p', '--port', type=int, default=8080,
+                        help='Port the fake box listens on. Default: 8080')
+    parser.add_argument('-s', '--size', type=int, default=200000,
+                        help='Size of the phone messages in bytes. Default: 200000')
+    parser.add_argument('--check', action='store_true',
+                        help='Download phone messages from the fake box and verify them.')
+    cli = parser.parse_args()
+
+    if cli.check:
+        sys.exit(check(cli.size))
+    serve(cli.port, cli.size)